@@ -1,40 +1,37 @@
+import argparse
+import os
+import sys
+
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../IRIS_model/training/common_functions'))
+from common_function import *
+
 gamma_file_name = 'results_phi_gamma/native_trainSetFiles_phi_pairwise_contact_well-9.5_9.5_0.7_10_gamma_filtered'
 phi_file_name = 'results_phi_gamma/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_-9.5_9.5_0.7_10'
 
-# Load gamma data
-gamma = np.loadtxt(
-    gamma_file_name,
-    dtype=complex,
-    converters={0: lambda s: complex(s.decode().replace('+-', '-'))}
-)
-
-# Determine number of phis in first line
-with open(phi_file_name, "r") as file:
-    first_line = file.readline()
-    total_phis = len(first_line.strip().split())
-
-# Count decoys
-num_decoys = sum(1 for _ in open(phi_file_name))
-
-# Initialize phi array
-phi_i_decoy = np.zeros((num_decoys, total_phis))
-
-# Load phi data
-with open(phi_file_name, "r") as file:
-    for i_decoy, line in enumerate(file):
-        if i_decoy >= num_decoys:
-            break
-        values = line.strip().split()
-        for i_phi, value in enumerate(values):
-            phi_i_decoy[i_decoy][i_phi] = float(value)
-
-# Calculate energy for each decoy
-e_decoy = np.zeros(num_decoys)
-for i_decoy in range(num_decoys):
-    e_decoy[i_decoy] = np.dot(gamma, phi_i_decoy[i_decoy])
-
-# Save results
-np.savetxt('Energy_mg.txt', e_decoy, fmt='%f', delimiter='\n')
-print("Energy calculation complete. Results saved to Energy_mg.txt")
+# Usage:
+#   python energy_calculation.py
+#       scores phi_file_name with gamma_file_name into Energy_mg.txt
+#   python energy_calculation.py PHI_FILE GAMMA_FILE [GAMMA_FILE ...] --output energies.npy
+#       scores every decoy of PHI_FILE (text phis, or the binary .phi store next to it) with every gamma file,
+#       e.g. the fox1, ms2, pum1, srp and u1a models, into a (decoys, models) float32 matrix;
+#       the gamma files of the columns are listed in energies.npy.models
+parser = argparse.ArgumentParser(description="Calculate the energies gamma . phi of decoy phis.")
+parser.add_argument("phi_file_name", nargs='?', default=phi_file_name)
+parser.add_argument("gamma_file_names", nargs='*', default=[gamma_file_name])
+parser.add_argument("--output", default=None, help="binary .npy energy matrix (default: Energy_mg.txt)")
+parser.add_argument("--chunk_size", type=int, default=100000, help="number of decoys scored at a time")
+args = parser.parse_args()
+
+if args.output is None:
+    # Energy of each decoy with the first gamma file, as text
+    energies = calculate_energy_matrix(args.phi_file_name, args.gamma_file_names[:1], chunk_size=args.chunk_size, dtype=float)
+    np.savetxt('Energy_mg.txt', energies[:, 0], fmt='%f', delimiter='\n')
+    print("Energy calculation complete. Results saved to Energy_mg.txt")
+else:
+    energies = calculate_energy_matrix(args.phi_file_name, args.gamma_file_names, output_file_name=args.output,
+                                       chunk_size=args.chunk_size)
+    with open(args.output + '.models', 'w') as models_file:
+        models_file.write('\n'.join(args.gamma_file_names) + '\n')
+    print("Energy calculation complete. %d decoys x %d models saved to %s" % (energies.shape[0], energies.shape[1], args.output))
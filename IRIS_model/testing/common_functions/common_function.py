@@ -5,6 +5,10 @@ import time
 import sys
 import functools
 import itertools
+import json
+import hashlib
+import shutil
+import heapq
 
 import numpy as np
 import random
@@ -12,6 +16,7 @@ import random
 
 # For Biopython
 from Bio.PDB import *
+from Bio.PDB.kdtrees import KDTree
 from Bio.Data.PDBData import protein_letters_3to1, protein_letters_1to3
 
 
@@ -60,6 +65,12 @@ res_name_map = {
 }
 
 
+# Residue names of the nucleotides, and the residue type of every residue name (nucleotides and the 20 amino acids);
+nucleotide_resnames = set([resname.strip() for resname in res_name_map.values()])
+res_type_by_resname = dict([(resname.strip(), res_type_map[resname.strip()]) for resname in res_name_map.values()] +
+                           [(resname, res_type_map[letter]) for resname, letter in protein_letters_3to1.items() if letter in res_type_map])
+
+
 def save_structure(structure, file_name):
     io = PDBIO()
     io.set_structure(structure)
@@ -183,8 +194,8 @@ def get_neighbor_list(structure, tm_only=False):
     if tm_only:
         tm = read_column_from_file(os.path.join(
             tms_directory, protein + '.tm'), 1)
-        atom_list = [a for a in atom_list if tm[get_global_index(
-            res_list, a.get_parent())] == '2']
+        residue_index_map = get_residue_index_map(res_list)
+        atom_list = [a for a in atom_list if tm[residue_index_map[get_residue_key(a.get_parent())]] == '2']
 
     neighbor_list = NeighborSearch(atom_list)
     return neighbor_list
@@ -229,33 +240,63 @@ def get_neighbors_within_radius(neighbor_list, residue, radius):
     return neighbor_list.search(get_interaction_atom(residue).get_coord(), radius, level='R')
 
 def get_interaction_atom(residue):
-    try:
-        if (residue.resname.strip() == "RA") or (residue.resname.strip() == "RU") or (residue.resname.strip() == "RC") or (residue.resname.strip() == "RG"):
-           # print(residue)
-            try:
-                residue["P"]
-               # print(residue["P"])
-                return residue["P"]
-            except KeyError:
-                try: 
-                    residue["O5'"]
-                   # print(residue["O5'"])
-                    return(residue["O5'"])
-                except:
-                    raise
-        else:
-            # Only use the CA atom here;
-            if residue.resname == "GLY":
-                return residue["CA"]
-            else:
-                return residue["CA"]
-    except:
-        raise
+    # The P atom of a nucleotide (O5' at the 5' end, where there is no P), the CA atom of an amino acid;
+    if residue.resname.strip() in nucleotide_resnames:
+        if "P" in residue:
+            return residue["P"]
+        return residue["O5'"]
+    # Only use the CA atom here;
+    return residue["CA"]
+
+
+def get_interaction_coords(res_list):
+    # Coordinates of the interaction atom of every residue, one row per residue (in the float32 of the PDB parser);
+    # NaN for a residue without one, which only matters if the residue is scored (see check_pdb_arrays_residues);
+    interaction_coords = np.full((len(res_list), 3), np.nan, dtype=np.float32)
+    for i, residue in enumerate(res_list):
+        try:
+            interaction_coords[i] = get_interaction_atom(residue).get_coord()
+        except KeyError:
+            continue
+    return interaction_coords
+
+
+def get_interaction_distances(interaction_coords, res1_indices, res2_indices):
+    # Same distances as get_interaction_distance of the residue pairs, from the interaction coordinate array; the squared
+    # norms go through a (batched) dot product like Atom.__sub__ does, so that the float32 distances agree bit for bit;
+    differences = interaction_coords[res1_indices] - interaction_coords[res2_indices]
+    return np.sqrt(np.matmul(differences[:, None, :], differences[:, :, None])[:, 0, 0])
 
 
 def get_global_index(residue_list, residue):
     return residue_list.index(residue)
 
+
+# The phi functions look residues up through these, built once per structure, instead of scanning the residue lists
+# with get_global_index or "residue in res_list_tmonly" for every neighbor;
+def get_residue_key(residue):
+    # The full ID without the structure ID, which is what residues compare equal on;
+    return residue.get_full_id()[1:]
+
+
+def get_residue_index_map(res_list):
+    # Global index of every residue of res_list: residue_index_map[get_residue_key(residue)] == get_global_index(res_list, residue);
+    return dict([(get_residue_key(residue), i) for i, residue in enumerate(res_list)])
+
+
+def get_tm_mask(res_list_tmonly, res_list_entire):
+    # Whether each residue of res_list_entire is in res_list_tmonly;
+    tm_keys = set([get_residue_key(residue) for residue in res_list_tmonly])
+    return np.array([get_residue_key(residue) in tm_keys for residue in res_list_entire], dtype=bool)
+
+
+def get_chain_ids(res_list):
+    return np.array([get_chain(residue) for residue in res_list], dtype=str)
+
+
+def get_local_indices(res_list):
+    return np.array([get_local_index(residue) for residue in res_list], dtype=int)
+
 def read_decoy_sequences(sequence_file_name):
     sequences = []
     with open(sequence_file_name, "r") as sequence_file:
@@ -264,6 +305,112 @@ def read_decoy_sequences(sequence_file_name):
             sequences.append(line)
     return sequences
 
+def read_randomize_positions(positions_file_name):
+    # The 1-based residue positions on the first line of randomize_position_*.txt, as 0-based indices;
+    with open(positions_file_name, 'r') as positions_file:
+        return np.array([int(position) - 1 for position in positions_file.readline().split()], dtype=int)
+
+def get_randomized_position_codes(sequences, positions, alphabet):
+    # Pack the residues of each sequence (a uint8 row) at positions into one integer in base len(alphabet), so that large
+    # sets of sequences that only differ there are compared with np.isin instead of string by string; the rows are packed
+    # into raw bytes instead when the integers would not fit in int64;
+    alphabet_index = np.full(256, len(alphabet), dtype=np.int64)
+    alphabet_index[np.frombuffer(alphabet.encode(), dtype=np.uint8)] = np.arange(len(alphabet))
+    digits = alphabet_index[sequences[:, positions]]
+    if (len(alphabet) + 1) ** len(positions) > np.iinfo(np.int64).max:
+        return np.ascontiguousarray(digits.astype(np.uint8)).view(np.dtype((np.void, len(positions)))).ravel()
+    return np.dot(digits, np.power(len(alphabet) + 1, np.arange(len(positions))[::-1], dtype=np.int64))
+
+def get_excluded_sequence_codes(native_sequence, excluded_sequences, positions, alphabet):
+    # Only the excluded sequences that agree with native_sequence outside positions, and only use letters of alphabet
+    # at positions, can ever be drawn as a decoy;
+    native = np.frombuffer(native_sequence.encode(), dtype=np.uint8)
+    excluded = [np.frombuffer(sequence.encode(), dtype=np.uint8) for sequence in excluded_sequences if len(sequence) == len(native)]
+    if len(excluded) == 0:
+        return np.zeros(0, dtype=np.int64)
+    excluded = np.array(excluded)
+    fixed_positions = np.ones(len(native), dtype=bool)
+    fixed_positions[positions] = False
+    excluded = excluded[(excluded[:, fixed_positions] == native[fixed_positions]).all(axis=1) &
+                        np.isin(excluded[:, positions], np.frombuffer(alphabet.encode(), dtype=np.uint8)).all(axis=1)]
+    return np.unique(get_randomized_position_codes(excluded, positions, alphabet))
+
+def sample_randomized_sequences(native_sequence, positions, alphabet, num_sequences, random_generator, excluded_codes=None):
+    # num_sequences copies of native_sequence, one row of characters (uint8) per sequence, in which the residues at
+    # positions are drawn uniformly and independently from alphabet by a numpy.random.Generator; sequences whose codes
+    # are in excluded_codes (see get_excluded_sequence_codes) are rejected and drawn again, so that exactly
+    # num_sequences sequences are returned;
+    alphabet_letters = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+    if excluded_codes is None:
+        excluded_codes = []
+    if len(excluded_codes) >= len(alphabet) ** len(set(positions)):
+        raise ValueError("All %d randomized sequences are excluded" % len(alphabet) ** len(set(positions)))
+    sequences = np.tile(np.frombuffer(native_sequence.encode(), dtype=np.uint8), (num_sequences, 1))
+    to_sample = np.arange(num_sequences)
+    while len(to_sample) > 0:
+        sequences[np.ix_(to_sample, positions)] = alphabet_letters[random_generator.integers(
+            0, len(alphabet), size=(len(to_sample), len(positions)))]
+        if len(excluded_codes) == 0:
+            break
+        to_sample = to_sample[np.isin(get_randomized_position_codes(sequences[to_sample], positions, alphabet), excluded_codes)]
+    return sequences
+
+def iterate_randomized_sequence_blocks(native_sequence, positions, alphabet, num_sequences, random_generator, excluded_codes=None, block_size=100000):
+    # Draws num_sequences randomized sequences (see sample_randomized_sequences), block_size sequences at a time;
+    for block_start in range(0, num_sequences, block_size):
+        yield sample_randomized_sequences(native_sequence, positions, alphabet, min(block_size, num_sequences - block_start),
+                                          random_generator, excluded_codes=excluded_codes)
+
+def get_sequence_array_res_types(sequences, num_residues):
+    # Residue types of the rows of a uint8 sequence array, as get_sequences_res_types does for strings;
+    res_types = res_type_lookup[sequences[:, :num_residues]]
+    if (res_types < 0).any() or res_types.shape[1] != num_residues:
+        raise KeyError("Unknown residue letter or wrong length in the sequence block")
+    return res_types
+
+def get_unique_randomized_sequences(native_sequence, positions, alphabet, num_sequences, random_generator, excluded_codes=None):
+    # Distinct randomized sequences with their multiplicity weights, standing for num_sequences sampled sequences;
+    # when there are at most num_sequences possible sequences (len(alphabet)^k for k positions) all of them are
+    # enumerated once with weight 1, otherwise num_sequences are sampled and the duplicates are merged into counts;
+    positions = np.unique(positions)
+    if excluded_codes is None:
+        excluded_codes = []
+    if len(alphabet) ** len(positions) - len(excluded_codes) <= num_sequences:
+        alphabet_letters = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+        codes = np.arange(len(alphabet) ** len(positions))
+        digits = (codes[:, None] // np.power(len(alphabet), np.arange(len(positions))[::-1])) % len(alphabet)
+        sequences = np.tile(np.frombuffer(native_sequence.encode(), dtype=np.uint8), (len(codes), 1))
+        sequences[:, positions] = alphabet_letters[digits]
+        if len(excluded_codes) > 0:
+            sequences = sequences[~np.isin(get_randomized_position_codes(sequences, positions, alphabet), excluded_codes)]
+        return sequences, np.ones(len(sequences), dtype=int)
+
+    sequences = sample_randomized_sequences(native_sequence, positions, alphabet, num_sequences, random_generator,
+                                            excluded_codes=excluded_codes)
+    # Keep the distinct sequences in the order they were first drawn;
+    codes, first_indices, counts = np.unique(get_randomized_position_codes(sequences, positions, alphabet),
+                                             return_index=True, return_counts=True)
+    order = np.argsort(first_indices)
+    return sequences[first_indices[order]], counts[order]
+
+decoy_weights_extension = ".weights"
+
+def write_decoy_weights(weights_file_name, weights):
+    np.savetxt(weights_file_name, weights, fmt='%g')
+
+def read_decoy_weights(weights_file_name, max_rows=None):
+    # Multiplicity weights of the decoys, or None for decoy sets without a weights file (every decoy counts once);
+    if not os.path.exists(weights_file_name):
+        return None
+    return np.loadtxt(weights_file_name, ndmin=1, max_rows=max_rows)
+
+def write_sequence_array(output_file, sequences):
+    # Write the rows of a uint8 sequence array to a binary file, one sequence per line, in one write;
+    lines = np.empty((sequences.shape[0], sequences.shape[1] + 1), dtype=np.uint8)
+    lines[:, :-1] = sequences
+    lines[:, -1] = ord('\n')
+    output_file.write(lines.tobytes())
+
 def mutate_whole_sequence(res_list, new_sequence):
     for i in range(len(res_list)):
         # If it is a protein sequence:
@@ -275,13 +422,7 @@ def mutate_whole_sequence(res_list, new_sequence):
     return res_list
 
 def get_res_type(res_list, residue):
-    # If it is RNA:
-    if (residue.get_resname().strip() == "RA") or (residue.get_resname().strip() == "RU") or (residue.get_resname().strip() == "RC") or (residue.get_resname().strip() == "RG"):
-       # print(residue)
-        return res_type_map[residue.get_resname().strip()]
-    # If it is protein:
-    else: 
-        return res_type_map[protein_letters_3to1.get(residue.get_resname(), None)]
+    return res_type_by_resname[residue.get_resname().strip()]
 
 def get_interaction_distance(res1, res2):
     return get_interaction_atom(res1) - get_interaction_atom(res2)
@@ -291,6 +432,454 @@ def interaction_well(r, r_min, r_max, kappa):
     return 0.5 * (np.tanh(kappa * (r - r_min)) * np.tanh(kappa * (r_max - r))) + 0.5
 
 
+def get_pair_phi_index_map(num_res_types=24):
+    # Position of the (i, j) residue-type pair in the upper-triangle phi vector, in the same order as
+    # phis_to_return is built in the phi functions; the map is symmetric, so (j, i) lands on the same phi;
+    pair_phi_index_map = np.zeros((num_res_types, num_res_types), dtype=int)
+    i_phi = 0
+    for i in range(num_res_types):
+        for j in range(i, num_res_types):
+            pair_phi_index_map[i][j] = pair_phi_index_map[j][i] = i_phi
+            i_phi += 1
+    return pair_phi_index_map
+
+
+def get_res_type_lookup():
+    # Residue type indexed by the ASCII code of a one-letter sequence symbol, following mutate_whole_sequence:
+    # upper case letters are amino acids, lower case letters are nucleotides;
+    res_type_lookup = np.full(128, -1, dtype=int)
+    for letter, res_type in res_type_map.items():
+        if len(letter) == 1:
+            res_type_lookup[ord(letter)] = res_type
+    for letter, resname in res_name_map.items():
+        res_type_lookup[ord(letter)] = res_type_map[resname.strip()]
+    return res_type_lookup
+
+
+pair_phi_index_map = get_pair_phi_index_map()
+res_type_lookup = get_res_type_lookup()
+
+
+def get_res_types(res_list, indices=None):
+    # Residue type of every residue of res_list, looked up once per residue so that the phi functions only index arrays;
+    # with indices, only those residues are typed (e.g. the residues of the contacting pairs) and the others are -1;
+    res_types = np.full(len(res_list), -1, dtype=int)
+    for i in (range(len(res_list)) if indices is None else indices):
+        resname = res_list[i].get_resname().strip()
+        if resname not in res_type_by_resname:
+            raise KeyError("Unknown residue name %s of residue %s %d" % (resname, get_chain(res_list[i]), get_local_index(res_list[i])))
+        res_types[i] = res_type_by_resname[resname]
+    return res_types
+
+
+def get_sequence_res_types(sequence, num_residues=None):
+    # Same residue types that get_res_type would return after mutate_whole_sequence(res_list, sequence);
+    if num_residues is None:
+        num_residues = len(sequence)
+    res_types = res_type_lookup[np.frombuffer(sequence[:num_residues].encode(), dtype=np.uint8)]
+    if (res_types < 0).any():
+        raise KeyError("Unknown residue letter in sequence %s" % sequence)
+    return res_types
+
+
+def get_phis_from_contact_pairs(res_types, res1_indices, res2_indices, weights):
+    # Scatter-add the precomputed well weights of every contacting pair onto the phi of its residue-type pair;
+    pair_phi_indices = pair_phi_index_map[res_types[res1_indices], res_types[res2_indices]]
+    return np.bincount(pair_phi_indices, weights=weights, minlength=pair_phi_index_map.max() + 1)
+
+
+def get_sequences_res_types(sequences, num_residues):
+    # Residue types of a block of equally long sequences, one row per sequence;
+    block = ''.join([sequence[:num_residues] for sequence in sequences])
+    res_types = res_type_lookup[np.frombuffer(block.encode(), dtype=np.uint8)]
+    if (res_types < 0).any() or len(res_types) != len(sequences) * num_residues:
+        raise KeyError("Unknown residue letter or wrong length in the sequence block")
+    return res_types.reshape(len(sequences), num_residues)
+
+
+def get_pair_weight_matrix(res1_indices, res2_indices, weights):
+    # Residue-pair weight matrix restricted to the residues that take part in at least one contact;
+    contact_residues, pair_indices = np.unique(np.concatenate((res1_indices, res2_indices)), return_inverse=True)
+    pair_weight_matrix = np.zeros((len(contact_residues), len(contact_residues)))
+    np.add.at(pair_weight_matrix, (pair_indices[:len(res1_indices)], pair_indices[len(res1_indices):]), weights)
+    return contact_residues, pair_weight_matrix
+
+
+def get_phis_from_pair_weight_matrix(res_types_block, pair_weight_matrix, num_res_types=24):
+    # contact[d, a, b] sums the weights of the pairs whose first residue has type a and second residue has type b in decoy d;
+    # the phi of a type pair a < b collects both orders, and agrees with the scalar path up to floating-point round-off;
+    one_hot = np.eye(num_res_types)[res_types_block]
+    contact = np.einsum('dia,ij,djb->dab', one_hot, pair_weight_matrix, one_hot, optimize=True)
+    diagonal = np.arange(num_res_types)
+    symmetric_contact = contact + contact.transpose(0, 2, 1)
+    symmetric_contact[:, diagonal, diagonal] = contact[:, diagonal, diagonal]
+    upper_i, upper_j = np.triu_indices(num_res_types)
+    return symmetric_contact[:, upper_i, upper_j]
+
+
+# The PDB arrays keep, per residue of a PDB, only what the pair phis read: the model, chain, residue number, insertion
+# code and name, and the coordinates of the interaction atom (NaN if the residue has none); the coordinates of all atoms
+# and their residue are kept as well, since the neighbor search looks for residues with any atom near an interaction atom;
+# they are read straight from the ATOM records, with the residue order, altloc selection and float32 coordinates
+# of PDBParser, and cached in an .npz next to the PDB that is rebuilt when the PDB changes;
+pdb_arrays_extension = ".arrays.npz"
+pdb_arrays_version = 2
+
+
+def read_pdb_arrays(pdb_file_name):
+    # Same residues as get_res_list(parse_pdb(...)): the residues of the HETATM records are left out, and those of every
+    # model are kept; as in the SMCRA hierarchy, residues are grouped by model and then by chain, in the order the models
+    # and chains first appear; like PDBParser, a model starts at a MODEL record or at the first atom after an ENDMDL;
+    chains = {}
+    residue_atoms = {}
+    model_id = -1
+    model_open = False
+    with open(pdb_file_name, 'r') as pdb_file:
+        for line in pdb_file:
+            record_type = line.rstrip("\n")[0:6]
+            if record_type == "MODEL ":
+                model_id += 1
+                model_open = True
+                continue
+            if record_type == "ENDMDL":
+                model_open = False
+                continue
+            if record_type == "END   " or record_type == "CONECT":
+                break
+            if record_type != "ATOM  " and record_type != "HETATM":
+                continue
+            if not model_open:
+                model_id += 1
+                model_open = True
+            if record_type == "HETATM":
+                continue
+            residue_key = (model_id, line[21], int(line[22:26]), line[26])
+            if residue_key not in residue_atoms:
+                chains.setdefault((model_id, line[21]), []).append((residue_key, line[17:20].strip()))
+                residue_atoms[residue_key] = {}
+            atom_name = line[12:16].strip() if len(line[12:16].split()) == 1 else line[12:16]
+            altloc = line[16]
+            try:
+                occupancy = float(line[54:60])
+            except ValueError:
+                occupancy = 0.0
+            atoms = residue_atoms[residue_key]
+            # Of the alternative locations of an atom, the one with the highest occupancy is kept (the first on a tie);
+            if atom_name in atoms and (altloc == ' ' or occupancy <= atoms[atom_name][1]):
+                continue
+            atoms[atom_name] = (np.array((float(line[30:38]), float(line[38:46]), float(line[46:54])), "f"), occupancy)
+
+    residues = [residue for chain_residues in chains.values() for residue in chain_residues]
+    interaction_coords = np.full((len(residues), 3), np.nan, dtype=np.float32)
+    atom_coords = []
+    atom_residue_indices = []
+    for i, (residue_key, resname) in enumerate(residues):
+        atoms = residue_atoms[residue_key]
+        # Same interaction atom as get_interaction_atom;
+        if resname in nucleotide_resnames:
+            atom_name = "P" if "P" in atoms else "O5'"
+        else:
+            atom_name = "CA"
+        if atom_name in atoms:
+            interaction_coords[i] = atoms[atom_name][0]
+        atom_coords.extend([coord for coord, occupancy in atoms.values()])
+        atom_residue_indices.extend([i] * len(atoms))
+
+    return {'model_ids': np.array([residue_key[0] for residue_key, resname in residues], dtype=int),
+            'chain_ids': np.array([residue_key[1] for residue_key, resname in residues], dtype=str),
+            'res_ids': np.array([residue_key[2] for residue_key, resname in residues], dtype=int),
+            'insertion_codes': np.array([residue_key[3] for residue_key, resname in residues], dtype=str),
+            'resnames': np.array([resname for residue_key, resname in residues], dtype=str),
+            'interaction_coords': interaction_coords,
+            'atom_coords': np.array(atom_coords, dtype=np.float32).reshape(-1, 3),
+            'atom_residue_indices': np.array(atom_residue_indices, dtype=int)}
+
+
+def load_pdb_arrays(pdb_file_name):
+    # The PDB arrays from the cache next to the PDB, or read from the PDB (and cached) if the PDB has changed since;
+    key = get_structure_artifact_key([pdb_file_name], ["pdb_arrays", pdb_arrays_version])
+    pdb_arrays_file_name = os.path.splitext(pdb_file_name)[0] + pdb_arrays_extension
+    if os.path.exists(pdb_arrays_file_name):
+        pdb_arrays = load_structure_artifact(pdb_arrays_file_name)
+        if str(pdb_arrays.pop('key', '')) == key:
+            return pdb_arrays
+
+    pdb_arrays = read_pdb_arrays(pdb_file_name)
+    try:
+        save_structure_artifact(pdb_arrays_file_name, dict(pdb_arrays, key=key))
+    except OSError:
+        # e.g. a read-only PDB folder; the arrays are then read from the PDB every time;
+        pass
+    return pdb_arrays
+
+
+def get_pdb_arrays(res_list, atom_list=None):
+    # The PDB arrays of already parsed residues, with the atoms of atom_list (by default, all atoms of res_list)
+    # for the neighbor search; the residues of the atoms have to be in res_list;
+    if atom_list is None:
+        atom_list = [atom for residue in res_list for atom in residue]
+    residue_index_map = get_residue_index_map(res_list)
+    return {'model_ids': np.array([residue.get_full_id()[1] for residue in res_list], dtype=int),
+            'chain_ids': get_chain_ids(res_list),
+            'res_ids': get_local_indices(res_list),
+            'insertion_codes': np.array([residue.get_id()[2] for residue in res_list], dtype=str),
+            'resnames': np.array([residue.get_resname().strip() for residue in res_list], dtype=str),
+            'interaction_coords': get_interaction_coords(res_list),
+            'atom_coords': np.array([atom.get_coord() for atom in atom_list], dtype=np.float32).reshape(-1, 3),
+            'atom_residue_indices': np.array([residue_index_map[get_residue_key(atom.get_parent())] for atom in atom_list], dtype=int)}
+
+
+def get_pdb_arrays_res_types(pdb_arrays):
+    # -1 for the residue names without a residue type, which the phis only accept for residues they do not score;
+    return np.array([res_type_by_resname.get(resname, -1) for resname in pdb_arrays['resnames']], dtype=int)
+
+
+def get_pdb_arrays_residue_label(pdb_arrays, index):
+    return "%s %d%s %s" % (pdb_arrays['chain_ids'][index], pdb_arrays['res_ids'][index], pdb_arrays['insertion_codes'][index].strip(),
+                           pdb_arrays['resnames'][index])
+
+
+def check_pdb_arrays_residues(pdb_arrays, indices, check_res_types=False):
+    # Raise a KeyError naming the first residue at indices without an interaction atom (or, with check_res_types, without
+    # a residue type), as get_interaction_atom and get_res_type did for the residues that were scored;
+    indices = np.asarray(indices, dtype=int)
+    missing_indices = indices[np.isnan(pdb_arrays['interaction_coords'][indices]).any(axis=1)]
+    if len(missing_indices) > 0:
+        raise KeyError("Residue %s has no interaction atom" % get_pdb_arrays_residue_label(pdb_arrays, missing_indices[0]))
+    if check_res_types:
+        for index in indices:
+            if pdb_arrays['resnames'][index] not in res_type_by_resname:
+                raise KeyError("Unknown residue name of residue %s" % get_pdb_arrays_residue_label(pdb_arrays, index))
+
+
+def read_tm_mask(tm_file_name, num_residues):
+    # Same residues as get_res_list(structure, tm_only=True), as a mask over all residues;
+    tm = read_column_from_file(tm_file_name, 1)
+    return np.array([tm[i] == '2' for i in range(num_residues)], dtype=bool)
+
+
+def get_pdb_neighbor_search(pdb_arrays):
+    # KD tree over all atoms of the PDB arrays, which finds the same atoms as get_neighbor_list(structure).search;
+    return KDTree(np.array(pdb_arrays['atom_coords'], dtype="d"), 10)
+
+
+def get_neighbor_residue_indices(neighbor_search, atom_residue_indices, center, radius):
+    # Indices of the residues with at least one atom within radius of center, in the order that NeighborSearch.search
+    # returns the residues;
+    points = neighbor_search.search(np.require(center, dtype="d", requirements="C"), radius)
+    return list(dict.fromkeys(atom_residue_indices[[point.index for point in points]].tolist()))
+
+
+# A structure artifact keeps, per complex, the arrays that scoring a sequence on it needs (residue types, chains,
+# interaction-atom coordinates, tm mask and the contacting pairs of a phi), so the PDB is only parsed once;
+# its file name carries a hash of the PDB and .tm files and the phi parameters, so it is rebuilt when any of them change,
+# and the steps after evaluate_phi find the artifact of the current structure from the same files; the chain selection
+# it was built with is kept inside it;
+structure_artifacts_directory = "./structure_artifacts/"
+structure_artifact_version = 2
+
+
+def get_structure_artifact_key(file_names, key_strings):
+    key = hashlib.sha1(('%d\0' % structure_artifact_version).encode())
+    for file_name in file_names:
+        with open(file_name, 'rb') as input_file:
+            key.update(hashlib.sha1(input_file.read()).digest())
+    for key_string in key_strings:
+        key.update(('%s\0' % key_string).encode())
+    return key.hexdigest()[:16]
+
+
+def get_structure_arrays(pdb_arrays, tm_mask):
+    return {'res_types': get_pdb_arrays_res_types(pdb_arrays),
+            'chain_ids': pdb_arrays['chain_ids'],
+            'res_ids': pdb_arrays['res_ids'],
+            'interaction_coords': pdb_arrays['interaction_coords'].astype(float),
+            'tm_mask': tm_mask}
+
+
+def get_structure_artifact_file_name(artifacts_directory, protein, phi, parameters_string, pdb_file_name, tm_file_name):
+    artifact_key = get_structure_artifact_key([pdb_file_name, tm_file_name], [phi, parameters_string])
+    return os.path.join(artifacts_directory, "%s_%s_%s_%s.npz" % (protein, phi, parameters_string, artifact_key))
+
+
+def find_structure_artifact(protein, phi, parameters_string, complex_directory=".",
+                            native_structures_subdirectory="native_structures_pdbs_with_virtual_cbs", tms_subdirectory="tms"):
+    # The artifact that evaluate_phi wrote in complex_directory for the current PDB and .tm files of protein;
+    # used by steps that run after evaluate_phi, so that they never score another structure than the current phis;
+    pdb_file_name = os.path.join(complex_directory, native_structures_subdirectory, protein + '.pdb')
+    tm_file_name = os.path.join(complex_directory, tms_subdirectory, protein + '.tm')
+    for file_name in [pdb_file_name, tm_file_name]:
+        if not os.path.exists(file_name):
+            raise IOError("%s is missing; run template_evaluate_phi.py in %s first" % (file_name, complex_directory))
+    artifact_file_name = os.path.normpath(get_structure_artifact_file_name(os.path.join(complex_directory, structure_artifacts_directory),
+                                                                           protein, phi, parameters_string, pdb_file_name, tm_file_name))
+    if not os.path.exists(artifact_file_name):
+        raise IOError("No structure artifact %s for the current %s and %s; run template_evaluate_phi.py in %s first" % (
+            artifact_file_name, pdb_file_name, tm_file_name, complex_directory))
+    return artifact_file_name
+
+
+def save_structure_artifact(file_name, artifact):
+    # Write to a temporary file first, so that an interrupted run never leaves a truncated artifact behind;
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+    temporary_file_name = file_name + '.%d.tmp' % os.getpid()
+    with open(temporary_file_name, 'wb') as artifact_file:
+        np.savez(artifact_file, **artifact)
+    os.replace(temporary_file_name, file_name)
+
+
+def load_structure_artifact(file_name):
+    with np.load(file_name) as artifact_file:
+        return {name: artifact_file[name] for name in artifact_file.files}
+
+
+# The phi cache keeps the phi files of a complex under a key made of the hashes of its PDB, .tm and decoy files, the phi
+# name and its parameters, so that runs in other folders (loocv, testing) reuse the phis instead of recomputing them;
+# an entry is a folder of files, and the least recently used entries are removed when the cache grows past its size;
+# the cache is off unless IRIS_PHI_CACHE names its folder, and phi_cache_version is bumped whenever the phi code or the
+# phi file format changes, so that entries written by older code are never reused;
+phi_cache_directory = os.environ.get("IRIS_PHI_CACHE", "")
+phi_cache_max_bytes = 20 * 1024 ** 3
+phi_cache_version = 1
+
+
+def get_phi_cache_key(file_names, key_strings):
+    return get_structure_artifact_key(file_names, ['phi_cache', phi_cache_version] + list(key_strings))
+
+
+def load_phi_cache_entry(cache_directory, key, output_file_names):
+    # Copy the files of the cached entry to output_file_names ({name in the entry: output file}); returns False if
+    # the entry is missing or does not have all the files;
+    entry_directory = os.path.join(cache_directory, key)
+    cached_file_names = {name: os.path.join(entry_directory, name) for name in output_file_names}
+    if not all([os.path.exists(cached_file_name) for cached_file_name in cached_file_names.values()]):
+        return False
+    for name, output_file_name in output_file_names.items():
+        os.makedirs(os.path.dirname(output_file_name) or '.', exist_ok=True)
+        shutil.copyfile(cached_file_names[name], output_file_name)
+    # The modification time of the entry folder records its last use for the eviction;
+    os.utime(entry_directory)
+    return True
+
+
+def save_phi_cache_entry(cache_directory, key, output_file_names, max_bytes=None):
+    # The entry is filled in a temporary folder and renamed at the end, so other runs never see a partial entry;
+    entry_directory = os.path.join(cache_directory, key)
+    temporary_directory = entry_directory + '.%d.tmp' % os.getpid()
+    os.makedirs(temporary_directory, exist_ok=True)
+    for name, output_file_name in output_file_names.items():
+        shutil.copyfile(output_file_name, os.path.join(temporary_directory, name))
+    if os.path.exists(entry_directory):
+        shutil.rmtree(entry_directory, ignore_errors=True)
+    try:
+        os.rename(temporary_directory, entry_directory)
+    except OSError:
+        # Another run stored the same entry in the meantime;
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    if max_bytes is not None:
+        evict_phi_cache(cache_directory, max_bytes)
+
+
+def get_phi_cache_entries(cache_directory):
+    # (last use, size in bytes, folder) of every complete entry of the cache;
+    entries = []
+    if not os.path.isdir(cache_directory):
+        return entries
+    for key in os.listdir(cache_directory):
+        entry_directory = os.path.join(cache_directory, key)
+        if key.endswith('.tmp') or not os.path.isdir(entry_directory):
+            continue
+        try:
+            entry_size = sum([os.path.getsize(os.path.join(entry_directory, file_name))
+                              for file_name in os.listdir(entry_directory)])
+            entries.append((os.path.getmtime(entry_directory), entry_size, entry_directory))
+        except OSError:
+            continue
+    return entries
+
+
+def evict_phi_cache(cache_directory, max_bytes):
+    # Remove the least recently used entries until the cache fits in max_bytes;
+    entries = sorted(get_phi_cache_entries(cache_directory))
+    cache_size = sum([entry_size for _, entry_size, _ in entries])
+    for _, entry_size, entry_directory in entries:
+        if cache_size <= max_bytes:
+            break
+        shutil.rmtree(entry_directory, ignore_errors=True)
+        cache_size -= entry_size
+    return cache_size
+
+
+# The binary phi store keeps one row of phis per native/decoy sequence after a fixed-size JSON header
+# (phi name, parameters, number of rows and phis), so that it can be memory-mapped instead of parsed;
+phi_store_extension = ".phi"
+phi_store_magic = b"IRISPHI1"
+phi_store_header_size = 512
+
+
+def write_phi_store_header(phi_store_file, phi, parameters_string, num_rows, num_phis):
+    header = json.dumps({'phi': phi, 'parameters': parameters_string, 'num_rows': int(num_rows),
+                         'num_phis': int(num_phis), 'dtype': '<f8'}).encode()
+    if len(header) > phi_store_header_size - len(phi_store_magic):
+        raise ValueError("Phi store header is too long: %s" % header)
+    phi_store_file.seek(0)
+    phi_store_file.write(phi_store_magic + header.ljust(phi_store_header_size - len(phi_store_magic)))
+
+
+def read_phi_store_header(phi_store_file_name):
+    with open(phi_store_file_name, 'rb') as phi_store_file:
+        header = phi_store_file.read(phi_store_header_size)
+    if not header.startswith(phi_store_magic):
+        raise ValueError("%s is not a phi store" % phi_store_file_name)
+    return json.loads(header[len(phi_store_magic):].decode())
+
+
+def open_phi_store(file_name, phi, parameters_string, num_phis):
+    phi_store_file = open(file_name + phi_store_extension, 'wb')
+    write_phi_store_header(phi_store_file, phi, parameters_string, 0, num_phis)
+    return phi_store_file
+
+
+def append_phi_store(phi_store_file, phis):
+    phi_store_file.write(np.ascontiguousarray(phis, dtype='<f8').tobytes())
+
+
+def close_phi_store(phi_store_file):
+    # The number of rows is only known after the last block, so it is written back into the header when closing;
+    phi_store_file.flush()
+    header = read_phi_store_header(phi_store_file.name)
+    num_rows = (phi_store_file.tell() - phi_store_header_size) // (8 * header['num_phis'])
+    write_phi_store_header(phi_store_file, header['phi'], header['parameters'], num_rows, header['num_phis'])
+    phi_store_file.close()
+
+
+def write_phi_store(file_name, phi, parameters_string, phis):
+    phis = np.atleast_2d(phis)
+    phi_store_file = open_phi_store(file_name, phi, parameters_string, phis.shape[1])
+    append_phi_store(phi_store_file, phis)
+    close_phi_store(phi_store_file)
+
+
+def read_phi_store(phi_store_file_name):
+    header = read_phi_store_header(phi_store_file_name)
+    if header['num_rows'] == 0:
+        return np.zeros((0, header['num_phis']))
+    return np.memmap(phi_store_file_name, dtype=header['dtype'], mode='r', offset=phi_store_header_size,
+                     shape=(header['num_rows'], header['num_phis']))
+
+
+def append_phi_text(output_file, phis):
+    for phis_to_write in np.atleast_2d(phis).tolist():
+        output_file.write(' '.join([str(value) for value in phis_to_write]) + '\n')
+
+
+def read_phi_file(file_name, max_rows=None):
+    # Read the binary phi store written next to file_name if there is one, otherwise the whitespace text phi file;
+    if os.path.exists(file_name + phi_store_extension):
+        return read_phi_store(file_name + phi_store_extension)[:max_rows]
+    return np.loadtxt(file_name, ndmin=2, max_rows=max_rows)
+
+
 def read_native_phi(protein, phi_list, total_phis, jackhmmer=False):
     phi_native = np.zeros(total_phis)
     i_phi = 0
@@ -299,46 +888,74 @@ def read_native_phi(protein, phi_list, total_phis, jackhmmer=False):
         parameters = phi_and_parameters[1]
         parameters_string = get_parameters_string(parameters)
         if jackhmmer:
-            input_file = open(os.path.join(jackhmmer_phis_directory, "%s_%s_native_%s" % (
-                phi, protein, parameters_string)), 'r')
+            phi_file_name = os.path.join(jackhmmer_phis_directory, "%s_%s_native_%s" % (
+                phi, protein, parameters_string))
         else:
-            input_file = open(os.path.join(phis_directory, "%s_%s_native_%s" % (
-                phi, protein, parameters_string)), 'r')
+            phi_file_name = os.path.join(phis_directory, "%s_%s_native_%s" % (
+                phi, protein, parameters_string))
 
-        for line in input_file:
-            line = line.strip().split()
-            for i_value, value_i in enumerate(line):
-                phi_native[i_phi] = float(line[i_value])
-                i_phi += 1
+        phi_values = read_phi_file(phi_file_name).flatten()
+        phi_native[i_phi:i_phi + len(phi_values)] = phi_values
+        i_phi += len(phi_values)
     return phi_native
 
+def get_decoy_phi_file_name(phi, protein, parameters_string, decoy_method, jackhmmer=False):
+    if jackhmmer:
+        return os.path.join(jackhmmer_phis_directory, "%s_%s_decoys_%s" % (
+            phi, protein, parameters_string))
+    return os.path.join(phis_directory, "%s_%s_decoys_%s_%s" % (
+        phi, protein, decoy_method, parameters_string))
+
+
 def read_decoy_phis(protein, phi_list, total_phis, num_phis, num_decoys, decoy_method, jackhmmer=False):
     phi_i_decoy = np.zeros((num_decoys, total_phis))
 
     for i_phi_function, phi_and_parameters in enumerate(phi_list):
         phi = phi_and_parameters[0]
         parameters = phi_and_parameters[1]
-        i_phi = phi_list.index(phi_and_parameters)
         parameters_string = get_parameters_string(parameters)
-        if jackhmmer:
-            input_file = open(os.path.join(jackhmmer_phis_directory, "%s_%s_decoys_%s" % (
-                phi, protein, parameters_string)), 'r')
-        else:
-            input_file = open(os.path.join(phis_directory, "%s_%s_decoys_%s_%s" % (
-                phi, protein, decoy_method, parameters_string)), 'r')
-        for i_decoy, line in enumerate(input_file):
-            if i_decoy >= num_decoys:
-                break
-            first_phi = np.cumsum(num_phis)[
-                i_phi_function] - num_phis[i_phi_function]
-            i_phi = first_phi
-            line = line.strip().split()
-            for i_value, value_i in enumerate(line):
-                phi_i_decoy[i_decoy][i_phi] = float(line[i_value])
-                i_phi += 1
+        phi_file_name = get_decoy_phi_file_name(
+            phi, protein, parameters_string, decoy_method, jackhmmer=jackhmmer)
+        first_phi = np.cumsum(num_phis)[
+            i_phi_function] - num_phis[i_phi_function]
+        phi_values = read_phi_file(phi_file_name, max_rows=num_decoys)
+        phi_i_decoy[:len(phi_values), first_phi:first_phi + num_phis[i_phi_function]] = phi_values
     return phi_i_decoy
 
 
+def iterate_phi_file_chunks(file_name, chunk_size, max_rows=None):
+    # Yields the rows of a phi file in blocks of at most chunk_size rows, without loading the whole file;
+    if os.path.exists(file_name + phi_store_extension):
+        phi_values = read_phi_store(file_name + phi_store_extension)[:max_rows]
+        for i_row in range(0, len(phi_values), chunk_size):
+            yield np.array(phi_values[i_row:i_row + chunk_size])
+        return
+    with open(file_name, 'r') as input_file:
+        lines = itertools.islice(input_file, max_rows)
+        while True:
+            chunk_lines = list(itertools.islice(lines, chunk_size))
+            if len(chunk_lines) == 0:
+                return
+            yield np.loadtxt(chunk_lines, ndmin=2)
+
+
+def read_decoy_phis_chunks(protein, phi_list, num_decoys, decoy_method, chunk_size, jackhmmer=False):
+    # Same phis as read_decoy_phis, yielded as blocks of at most chunk_size decoys;
+    chunk_iterators = []
+    for phi, parameters in phi_list:
+        phi_file_name = get_decoy_phi_file_name(
+            phi, protein, get_parameters_string(parameters), decoy_method, jackhmmer=jackhmmer)
+        chunk_iterators.append(iterate_phi_file_chunks(phi_file_name, chunk_size, max_rows=num_decoys))
+    for chunks in zip(*chunk_iterators):
+        yield np.concatenate(chunks, axis=1)
+
+
+def read_decoy_phis_weights(protein, phi_list, num_decoys, decoy_method, jackhmmer=False):
+    # All phis of a protein are evaluated on the same decoys, so the weights written next to the first phi apply to all;
+    phi, parameters = phi_list[0]
+    phi_file_name = get_decoy_phi_file_name(
+        phi, protein, get_parameters_string(parameters), decoy_method, jackhmmer=jackhmmer)
+    return read_decoy_weights(phi_file_name + decoy_weights_extension, max_rows=num_decoys)
 
 
 def get_total_phis_and_parameter_string(phi_list, training_set):
@@ -358,10 +975,9 @@ def get_total_phis_and_parameter_string(phi_list, training_set):
         for i_protein, protein in enumerate(training_set):
             if i_protein > 0:
                 break
-            input_file = open(os.path.join(phis_directory, "%s_%s_native_%s" % (
-                phi, protein, parameters_string)), 'r')
-            for line in input_file:
-                line = line.strip().split()
+            phi_values = read_phi_file(os.path.join(phis_directory, "%s_%s_native_%s" % (
+                phi, protein, parameters_string)))
+            for line in phi_values:
                 num_phis.append(len(line))
                 total_phis += len(line)
     return total_phis, full_parameters_string, num_phis
@@ -374,14 +990,55 @@ def sort_eigenvalues_and_eigenvectors(eigenvalues, eigenvectors):
     eigenvectors = eigenvectors[:, idx]
     return eigenvalues, eigenvectors
 
-# These three functions provide a way of calling a function multiple times (that run independently)
+# These functions provide a way of calling a function multiple times (that run independently)
 # on a certain number of processors so that a new function call starts when a processor becomes available
 
 
-def call_independent_functions_on_n_processors(function, arguments_lists, num_processors):
-    from multiprocessing import Pool
-    pool = Pool(int(num_processors))
-    results = pool.map(universal_worker, pool_args(function, *arguments_lists))
+def call_independent_functions_on_n_processors(function, arguments_lists, num_processors, chunksize=1, shared_data=None):
+    return list(iterate_independent_functions_on_n_processors(function, arguments_lists, num_processors,
+                                                              chunksize=chunksize, shared_data=shared_data))
+
+
+def iterate_independent_functions_on_n_processors(function, arguments_lists, num_processors, chunksize=1, shared_data=None):
+    # Yields the results in the order of arguments_lists as they become available, and closes the pool when done;
+    # shared_data (e.g. the geometry of a complex) is handed to the workers once, through fork where available,
+    # instead of being pickled with every call; the called function gets it with get_pool_shared_data();
+    global pool_shared_data
+    pool_shared_data = shared_data
+    try:
+        if int(num_processors) <= 1:
+            for input_pair in pool_args(function, *arguments_lists):
+                yield universal_worker(input_pair)
+            return
+
+        import multiprocessing
+        if 'fork' in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context('fork').Pool(int(num_processors))
+        else:
+            pool = multiprocessing.Pool(int(num_processors), initializer=set_pool_shared_data, initargs=(shared_data,))
+        try:
+            for result in pool.imap(universal_worker, pool_args(function, *arguments_lists), chunksize=chunksize):
+                yield result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        pool_shared_data = None
+
+
+pool_shared_data = None
+
+
+def set_pool_shared_data(shared_data):
+    global pool_shared_data
+    pool_shared_data = shared_data
+
+
+def get_pool_shared_data():
+    return pool_shared_data
 
 
 def universal_worker(input_pair):
@@ -442,6 +1099,17 @@ def read_decoy_phi_structures_provided(protein, phi_list, total_phis, jackhmmer=
 
 
 
+def read_gamma_file(gamma_file_name):
+    # Gammas are written as real numbers; filtered gamma files from the old eig-based solver were
+    # written as complex numbers (e.g. "(-1.2e-02+-0.0e+00j)"), of which only the real part is kept;
+    try:
+        return np.loadtxt(gamma_file_name)
+    except ValueError:
+        gamma = np.loadtxt(gamma_file_name, dtype=complex, converters={
+                           0: lambda s: complex((s.decode() if isinstance(s, bytes) else s).replace('+-', '-'))})
+        return np.real(gamma)
+
+
 def read_all_gammas(phi_list_file_name, training_set_file, training_decoy_method, gamma_file_name=None, noise_filtering=True, read_confidence=False, bootstrapping_confidence=95, bootstrapping_iterations=1000, read_averaged_gammas=False, read_original_phis=False):
     phi_list = read_phi_list(phi_list_file_name)
     training_set = read_column_from_file(training_set_file, 1)
@@ -475,12 +1143,7 @@ def read_all_gammas(phi_list_file_name, training_set_file, training_decoy_method
         confidence_upper = np.loadtxt(os.path.join(gammas_directory, "%s_%s_confidence_upper_%d_%d" % (training_set_file.split(
             '/')[-1].split('.')[0], full_parameters_string, bootstrapping_confidence, bootstrapping_iterations)))
 
-    # Need to filter out the complex number if in the "filtered" mode;
-    if noise_filtering:
-        gamma = np.loadtxt(gamma_file_name, dtype=complex, converters={
-                           0: lambda s: complex(s.decode().replace('+-', '-'))})
-    else:
-        gamma = np.loadtxt(gamma_file_name)
+    gamma = read_gamma_file(gamma_file_name)
 
     individual_gammas = []
     individual_confidence_lower = []
@@ -501,3 +1164,272 @@ def read_all_gammas(phi_list_file_name, training_set_file, training_decoy_method
     else:
         return individual_gammas
 
+
+
+# Energies are gamma . phi; the phis of many sequences are scored against the gammas of several models at once
+# (one column per gamma file), a block of phis at a time, so that a decoy library never has to fit in memory;
+def read_gamma_matrix(gamma_file_names):
+    gammas = [read_gamma_file(gamma_file_name) for gamma_file_name in gamma_file_names]
+    if len(set([len(gamma) for gamma in gammas])) > 1:
+        raise ValueError("The gamma files have different numbers of phis: %s" % ', '.join(
+            ["%s (%d)" % (gamma_file_name, len(gamma)) for gamma_file_name, gamma in zip(gamma_file_names, gammas)]))
+    return np.column_stack(gammas)
+
+
+def get_phi_file_num_rows(file_name):
+    if os.path.exists(file_name + phi_store_extension):
+        return read_phi_store_header(file_name + phi_store_extension)['num_rows']
+    with open(file_name, 'rb') as input_file:
+        return sum([1 for line in input_file if line.strip()])
+
+
+def iterate_energies(phi_file_name, gamma_matrix, chunk_size=100000, max_rows=None):
+    # Yields the energies of the rows of a phi file (binary store or text) as (rows in the block, models) blocks;
+    for phis_block in iterate_phi_file_chunks(phi_file_name, chunk_size, max_rows=max_rows):
+        if phis_block.shape[1] != gamma_matrix.shape[0]:
+            raise ValueError("%s has %d phis, the gammas have %d" % (phi_file_name, phis_block.shape[1], gamma_matrix.shape[0]))
+        yield phis_block.dot(gamma_matrix)
+
+
+def calculate_energy_matrix(phi_file_name, gamma_file_names, output_file_name=None, chunk_size=100000, max_rows=None, dtype=np.float32):
+    # Energies of every row of the phi file for every gamma file, as a (rows, models) matrix; with output_file_name,
+    # the matrix is written block by block into a .npy file and returned memory-mapped;
+    gamma_matrix = read_gamma_matrix(gamma_file_names)
+    num_rows = get_phi_file_num_rows(phi_file_name)
+    if max_rows is not None:
+        num_rows = min(num_rows, max_rows)
+    if output_file_name is None:
+        energies = np.zeros((num_rows, len(gamma_file_names)), dtype=dtype)
+    else:
+        energies = np.lib.format.open_memmap(output_file_name, mode='w+', dtype=dtype, shape=(num_rows, len(gamma_file_names)))
+    i_row = 0
+    for energies_block in iterate_energies(phi_file_name, gamma_matrix, chunk_size=chunk_size, max_rows=num_rows):
+        energies[i_row:i_row + len(energies_block)] = energies_block
+        i_row += len(energies_block)
+    if output_file_name is not None:
+        energies.flush()
+    return energies
+
+
+# Since phi sums the well weights of the contacting pairs onto their residue-type pair, gamma . phi is a sum over the
+# contacting pairs of weight * gamma[pair phi index of their two types]; folding gamma into a 24x24 pair-energy table
+# per phi scores a sequence on a complex directly from its residue types, without computing its phis;
+def get_pair_energy_table(gamma):
+    if len(gamma) != pair_phi_index_map.max() + 1:
+        raise ValueError("A pair gamma has %d values, not %d" % (len(gamma), pair_phi_index_map.max() + 1))
+    return np.asarray(gamma, dtype=float)[pair_phi_index_map]
+
+
+def get_sequence_energy_model(artifacts, gammas):
+    # artifacts and gammas follow the phi list: the structure artifact of the complex for each phi (with its contacting
+    # pairs), and the gamma of each phi as read_all_gammas returns them; the pairs of all phis are scored together;
+    if len(artifacts) != len(gammas):
+        raise ValueError("%d structure artifacts for %d gammas" % (len(artifacts), len(gammas)))
+    energy_model = {'num_residues': len(artifacts[0]['res_types']),
+                    'native_res_types': artifacts[0]['res_types'],
+                    'res1_indices': np.concatenate([artifact['res1_indices'] for artifact in artifacts]).astype(int),
+                    'res2_indices': np.concatenate([artifact['res2_indices'] for artifact in artifacts]).astype(int),
+                    'weights': np.concatenate([artifact['weights'] for artifact in artifacts]).astype(float),
+                    'table_indices': np.concatenate([np.full(len(artifact['weights']), i_phi, dtype=int)
+                                                     for i_phi, artifact in enumerate(artifacts)]),
+                    'pair_energy_tables': np.array([get_pair_energy_table(gamma) for gamma in gammas])}
+    energy_model['residue_pair_offsets'], energy_model['residue_pairs'] = get_residue_pairs(
+        energy_model['res1_indices'], energy_model['res2_indices'], energy_model['num_residues'])
+    return energy_model
+
+
+def get_residue_pairs(res1_indices, res2_indices, num_residues):
+    # The contacting pairs of residue i are residue_pairs[residue_pair_offsets[i]:residue_pair_offsets[i + 1]];
+    residues = np.concatenate((res1_indices, res2_indices))
+    pairs = np.concatenate((np.arange(len(res1_indices)), np.arange(len(res2_indices))))
+    residue_pair_offsets = np.concatenate(([0], np.cumsum(np.bincount(residues, minlength=num_residues))))
+    return residue_pair_offsets, pairs[np.argsort(residues, kind='stable')]
+
+
+def read_sequence_energy_model(protein, phi_list, gammas, complex_directory="."):
+    # Energy model of protein from the structure artifacts written by evaluate_phi in complex_directory for the phis of phi_list;
+    artifacts = [load_structure_artifact(find_structure_artifact(protein, phi, get_parameters_string(parameters), complex_directory=complex_directory))
+                 for phi, parameters in phi_list]
+    return get_sequence_energy_model(artifacts, gammas)
+
+
+def get_res_types_energies(energy_model, res_types_block):
+    # Energies of a (sequences, residues) block of residue types;
+    pair_energies = energy_model['pair_energy_tables'][energy_model['table_indices'],
+                                                       res_types_block[:, energy_model['res1_indices']],
+                                                       res_types_block[:, energy_model['res2_indices']]]
+    return pair_energies.dot(energy_model['weights'])
+
+
+def get_sequence_energies(energy_model, sequences, block_size=10000):
+    # Energy of one sequence string, or the energies of a list of sequences (or a uint8 sequence array), scored in
+    # blocks of block_size sequences; the same values as gamma . phi of the sequences up to floating-point round-off;
+    if isinstance(sequences, str):
+        return get_res_types_energies(energy_model, get_sequence_res_types(sequences, energy_model['num_residues'])[None, :])[0]
+    energies = np.zeros(len(sequences))
+    for i_block in range(0, len(sequences), block_size):
+        if isinstance(sequences, np.ndarray):
+            res_types_block = get_sequence_array_res_types(sequences[i_block:i_block + block_size], energy_model['num_residues'])
+        else:
+            res_types_block = get_sequences_res_types(sequences[i_block:i_block + block_size], energy_model['num_residues'])
+        energies[i_block:i_block + block_size] = get_res_types_energies(energy_model, res_types_block)
+    return energies
+
+
+# A mutant only changes the energy of the contacting pairs of its mutated positions, so its energy change from a base
+# sequence is computed on those pairs alone; positions are 0-based indices in the complex sequence, as the ones
+# read_randomize_positions returns, and residues are one-letter symbols (upper case amino acids, lower case nucleotides);
+def get_base_res_types(energy_model, base_sequence):
+    if isinstance(base_sequence, str):
+        return get_sequence_res_types(base_sequence, energy_model['num_residues'])
+    return np.asarray(base_sequence, dtype=int)
+
+
+def get_letters_res_types(letters):
+    res_types = res_type_lookup[np.frombuffer(''.join(letters).encode(), dtype=np.uint8)]
+    if (res_types < 0).any() or len(res_types) != len(letters):
+        raise KeyError("Unknown residue letter in %s" % ''.join(letters))
+    return res_types
+
+
+def get_position_rows(energy_model, positions):
+    # Row of each residue in positions, -1 for the other residues;
+    if len(np.unique(positions)) != len(positions):
+        raise ValueError("The mutated positions are not distinct")
+    position_rows = np.full(energy_model['num_residues'], -1, dtype=int)
+    position_rows[positions] = np.arange(len(positions))
+    return position_rows
+
+
+def get_pairs_energy(energy_model, res_types, pairs):
+    return energy_model['pair_energy_tables'][energy_model['table_indices'][pairs], res_types[energy_model['res1_indices'][pairs]],
+                                              res_types[energy_model['res2_indices'][pairs]]].dot(energy_model['weights'][pairs])
+
+
+def get_mutation_energy_change(energy_model, base_sequence, mutations):
+    # Energy change of the mutant given by mutations, a list of (position, residue letter) substitutions of base_sequence;
+    base_res_types = get_base_res_types(energy_model, base_sequence)
+    positions = np.array([position for position, _ in mutations], dtype=int)
+    offsets = energy_model['residue_pair_offsets']
+    pairs = np.unique(np.concatenate([energy_model['residue_pairs'][offsets[position]:offsets[position + 1]]
+                                      for position in positions] + [np.zeros(0, dtype=int)]))
+    mutant_res_types = base_res_types.copy()
+    mutant_res_types[positions] = get_letters_res_types([letter for _, letter in mutations])
+    return get_pairs_energy(energy_model, mutant_res_types, pairs) - get_pairs_energy(energy_model, base_res_types, pairs)
+
+
+def get_single_mutation_energy_changes(energy_model, base_sequence, positions, letters):
+    # Energy changes of every single mutant of base_sequence at positions to letters, as a (positions, letters) matrix;
+    base_res_types = get_base_res_types(energy_model, base_sequence)
+    letter_res_types = get_letters_res_types(letters)
+    position_rows = get_position_rows(energy_model, positions)
+    tables = energy_model['pair_energy_tables']
+    energy_changes = np.zeros((len(positions), len(letters)))
+    for own_indices, other_indices in [(energy_model['res1_indices'], energy_model['res2_indices']),
+                                       (energy_model['res2_indices'], energy_model['res1_indices'])]:
+        selected = position_rows[own_indices] >= 0
+        table_indices = energy_model['table_indices'][selected][:, None]
+        other_res_types = base_res_types[other_indices[selected]][:, None]
+        own_res_types = base_res_types[own_indices[selected]][:, None]
+        if own_indices is energy_model['res1_indices']:
+            pair_energy_changes = tables[table_indices, letter_res_types[None, :], other_res_types] - tables[table_indices, own_res_types, other_res_types]
+        else:
+            pair_energy_changes = tables[table_indices, other_res_types, letter_res_types[None, :]] - tables[table_indices, other_res_types, own_res_types]
+        np.add.at(energy_changes, position_rows[own_indices[selected]], energy_model['weights'][selected][:, None] * pair_energy_changes)
+    return energy_changes
+
+
+def get_double_mutation_couplings(energy_model, base_sequence, positions, letters):
+    # A double mutant at positions i and j changes the energy by the sum of its two single mutants, plus a coupling from
+    # the pairs between i and j; returns the (i, j) rows of positions that are in contact (i < j), and their couplings
+    # as a (contacting position pairs, letters at i, letters at j) array; the couplings of the other pairs are zero;
+    base_res_types = get_base_res_types(energy_model, base_sequence)
+    letter_res_types = get_letters_res_types(letters)
+    position_rows = get_position_rows(energy_model, positions)
+    rows_1 = position_rows[energy_model['res1_indices']]
+    rows_2 = position_rows[energy_model['res2_indices']]
+    selected = np.flatnonzero((rows_1 >= 0) & (rows_2 >= 0) & (rows_1 != rows_2))
+    if len(selected) == 0:
+        return np.zeros((0, 2), dtype=int), np.zeros((0, len(letters), len(letters)))
+
+    # Orient every pair so that its first residue has the lower row;
+    swapped = rows_1[selected] > rows_2[selected]
+    row_pairs = np.column_stack([np.where(swapped, rows_2[selected], rows_1[selected]), np.where(swapped, rows_1[selected], rows_2[selected])])
+    position_pairs, pair_groups = np.unique(row_pairs, axis=0, return_inverse=True)
+    tables = energy_model['pair_energy_tables'][energy_model['table_indices'][selected]]
+    # The tables are indexed [first residue type, second residue type] of the pair as stored; transpose the swapped ones;
+    tables[swapped] = tables[swapped].transpose(0, 2, 1)
+    base_1 = np.where(swapped, base_res_types[energy_model['res2_indices'][selected]], base_res_types[energy_model['res1_indices'][selected]])
+    base_2 = np.where(swapped, base_res_types[energy_model['res1_indices'][selected]], base_res_types[energy_model['res2_indices'][selected]])
+    pair_index = np.arange(len(selected))[:, None, None]
+    pair_couplings = (tables[pair_index, letter_res_types[None, :, None], letter_res_types[None, None, :]]
+                      - tables[pair_index, letter_res_types[None, :, None], base_2[:, None, None]]
+                      - tables[pair_index, base_1[:, None, None], letter_res_types[None, None, :]]
+                      + tables[pair_index, base_1[:, None, None], base_2[:, None, None]])
+    couplings = np.zeros((len(position_pairs), len(letters), len(letters)))
+    np.add.at(couplings, pair_groups.ravel(), energy_model['weights'][selected][:, None, None] * pair_couplings)
+    return position_pairs, couplings
+
+
+# Saturation mutagenesis: every single (and optionally double) substitution at the given sites is scored from the single
+# mutant energy changes and the double mutant couplings, and only the top_k lowest energy changes (the most stabilizing
+# mutants) are kept, in a bounded heap, instead of sorting all of them;
+mutation_scan_alphabets = {'RNA': "agcu", 'protein': "ARNDCEQGHILKMFPSTWYV"}
+
+
+def get_res_type_letter_map():
+    # One-letter symbol of each residue type: upper case amino acids, lower case nucleotides;
+    res_type_letters = {}
+    for letter in mutation_scan_alphabets['protein'] + mutation_scan_alphabets['RNA']:
+        res_type_letters.setdefault(int(res_type_lookup[ord(letter)]), letter)
+    return res_type_letters
+
+
+def push_smallest_values(heap, top_k, values, get_item):
+    # Push the finite values of the array with their get_item(flat index) into heap, a max-heap of (-value, item)
+    # holding the top_k smallest values seen so far; only the top_k smallest of the block can enter it;
+    values = values.ravel()
+    candidates = np.flatnonzero(np.isfinite(values))
+    if len(candidates) > top_k:
+        candidates = candidates[np.argpartition(values[candidates], top_k - 1)[:top_k]]
+    for index in candidates:
+        if len(heap) < top_k:
+            heapq.heappush(heap, (-values[index], get_item(index)))
+        elif -values[index] > heap[0][0]:
+            heapq.heappushpop(heap, (-values[index], get_item(index)))
+
+
+def scan_mutations(energy_model, base_sequence, sites, top_k=100, doubles=False):
+    # sites lists (positions, alphabet) pairs, e.g. the RNA positions with "agcu" and the protein positions with
+    # "ARNDCEQGHILKMFPSTWYV"; returns the top_k mutants with the lowest energy change from base_sequence, from the
+    # lowest, as (energy change, ((position, letter), ...)); substitutions to the base residue are skipped;
+    base_res_types = get_base_res_types(energy_model, base_sequence)
+    positions = np.concatenate([np.asarray(site_positions, dtype=int) for site_positions, _ in sites])
+    letters = ''
+    for _, alphabet in sites:
+        letters += ''.join([letter for letter in alphabet if letter not in letters])
+    allowed = np.zeros((len(positions), len(letters)), dtype=bool)
+    i_position = 0
+    for site_positions, alphabet in sites:
+        allowed[i_position:i_position + len(site_positions), [letters.index(letter) for letter in alphabet]] = True
+        i_position += len(site_positions)
+    allowed &= get_letters_res_types(letters)[None, :] != base_res_types[positions][:, None]
+
+    single_energy_changes = get_single_mutation_energy_changes(energy_model, base_res_types, positions, letters)
+    heap = []
+    push_smallest_values(heap, top_k, np.where(allowed, single_energy_changes, np.inf),
+                         lambda index: ((int(positions[index // len(letters)]), letters[index % len(letters)]),))
+
+    if doubles:
+        position_pairs, couplings = get_double_mutation_couplings(energy_model, base_res_types, positions, letters)
+        for i in range(len(positions) - 1):
+            # Energy changes of the double mutants of position i with every later position j, as (j, letter at i, letter at j);
+            energy_changes = single_energy_changes[i][None, :, None] + single_energy_changes[i + 1:][:, None, :]
+            coupled = position_pairs[:, 0] == i
+            energy_changes[position_pairs[coupled, 1] - i - 1] += couplings[coupled]
+            energy_changes[~(allowed[i][None, :, None] & allowed[i + 1:][:, None, :])] = np.inf
+            push_smallest_values(heap, top_k, energy_changes, lambda index, i=i: (
+                (int(positions[i]), letters[index // len(letters) % len(letters)]),
+                (int(positions[i + 1 + index // len(letters) ** 2]), letters[index % len(letters)])))
+
+    return [(-negative_energy_change, mutations) for negative_energy_change, mutations in sorted(heap, reverse=True)]
@@ -0,0 +1,70 @@
+###########################################################################
+# This script scans every single (and optionally double) substitution at the
+# interface sites of the tested complex with a trained gamma, and writes the
+# top-K most stabilizing mutants (lowest energy change) as a ranked table;
+# evaluate_phi.py must have been run once, to write the structure artifacts
+#
+# Usage: python mutational_scan.py gamma_file [--doubles] [--top_k K] [--output mutational_scan.txt]
+###########################################################################
+
+import argparse
+import os
+import sys
+import numpy as np
+
+sys.path.append('/common_functions')
+from common_function import *
+
+################################################
+
+
+def read_site_positions(positions_file_name):
+    # The randomization sites of a randomize_position file, none if the file is missing or empty;
+    if not os.path.exists(positions_file_name):
+        return np.zeros(0, dtype=int)
+    return read_randomize_positions(positions_file_name)
+
+
+def mutational_scan(gamma_file_name, output_file_name, top_k=100, doubles=False, protein="native_Rmodified", phi_list_file_name="phi1_list.txt",
+                    RNA_positions_file_name="sequences/randomize_position_RNA.txt", prot_positions_file_name="sequences/randomize_position_prot.txt",
+                    base_sequence_file_name=None):
+    phi_list = read_phi_list(phi_list_file_name)
+    gammas = np.split(read_gamma_file(gamma_file_name), len(phi_list))
+    energy_model = read_sequence_energy_model(protein, phi_list, gammas)
+
+    # Mutants are taken from the native residue types of the structure, unless a base sequence is given; residues without
+    # a residue type (nonstandard residues, -1) are never in a contacting pair, so they are kept as -1 and shown as '-';
+    if base_sequence_file_name is None:
+        base_res_types = np.asarray(energy_model['native_res_types'], dtype=int)
+        res_type_letters = get_res_type_letter_map()
+        base_sequence = ''.join([res_type_letters.get(res_type, '-') for res_type in base_res_types])
+    else:
+        base_sequence = read_decoy_sequences(base_sequence_file_name)[0]
+        base_res_types = get_base_res_types(energy_model, base_sequence)
+    base_energy = get_res_types_energies(energy_model, base_res_types[None, :])[0]
+
+    sites = [(read_site_positions(RNA_positions_file_name), mutation_scan_alphabets['RNA']),
+             (read_site_positions(prot_positions_file_name), mutation_scan_alphabets['protein'])]
+    sites = [(positions, alphabet) for positions, alphabet in sites if len(positions) > 0]
+    top_mutants = scan_mutations(energy_model, base_res_types, sites, top_k=top_k, doubles=doubles)
+
+    with open(output_file_name, 'w') as output_file:
+        output_file.write("# rank delta_E energy mutations (base energy %f)\n" % base_energy)
+        for rank, (energy_change, mutations) in enumerate(top_mutants):
+            output_file.write("%d %f %f %s\n" % (rank + 1, energy_change, base_energy + energy_change, ','.join(
+                ["%s%d%s" % (base_sequence[position], position + 1, letter) for position, letter in mutations])))
+    print("Wrote the %d most stabilizing mutants to %s" % (len(top_mutants), output_file_name))
+
+############################################################################
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rank the single and double mutants of the interface sites by their energy change.")
+    parser.add_argument("gamma_file_name")
+    parser.add_argument("--doubles", action="store_true", help="also scan every pair of substitutions")
+    parser.add_argument("--top_k", type=int, default=100, help="number of mutants kept in the ranked table")
+    parser.add_argument("--output", default="mutational_scan.txt")
+    parser.add_argument("--base_sequence_file", default=None, help="sequence file whose first sequence is mutated (default: the native sequence)")
+    args = parser.parse_args()
+
+    mutational_scan(args.gamma_file_name, args.output, top_k=args.top_k, doubles=args.doubles, base_sequence_file_name=args.base_sequence_file)
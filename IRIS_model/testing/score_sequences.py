@@ -0,0 +1,42 @@
+###########################################################################
+# This script scores the decoy sequences of the tested complex directly from
+# its contacting pairs and a trained gamma, without evaluating their phis;
+# evaluate_phi.py must have been run once, to write the structure artifacts
+#
+# Usage: python score_sequences.py gamma_file [decoys_file] [energy_file]
+###########################################################################
+
+import os
+import sys
+import numpy as np
+
+sys.path.append('/common_functions')
+from common_function import *
+
+################################################
+
+
+def score_sequences(gamma_file_name, decoys_file_name, energy_file_name, protein="native_Rmodified", phi_list_file_name="phi1_list.txt"):
+    phi_list = read_phi_list(phi_list_file_name)
+    # The gamma file holds the gammas of all phis of the phi list one after the other;
+    gamma = read_gamma_file(gamma_file_name)
+    num_pair_phis = pair_phi_index_map.max() + 1
+    if len(gamma) != num_pair_phis * len(phi_list):
+        raise ValueError("%s has %d gammas, the %d phis of %s need %d" % (
+            gamma_file_name, len(gamma), len(phi_list), phi_list_file_name, num_pair_phis * len(phi_list)))
+    gammas = np.split(gamma, len(phi_list))
+
+    energy_model = read_sequence_energy_model(protein, phi_list, gammas)
+    energies = get_sequence_energies(energy_model, read_decoy_sequences(decoys_file_name))
+    np.savetxt(energy_file_name, energies, fmt='%f')
+    print("Scored %d sequences, energies saved to %s" % (len(energies), energy_file_name))
+
+############################################################################
+
+
+if __name__ == "__main__":
+    gamma_file_name = sys.argv[1]
+    decoys_file_name = sys.argv[2] if len(sys.argv) > 2 else "sequences/CPLEX_randomization/native_Rmodified.decoys"
+    energy_file_name = sys.argv[3] if len(sys.argv) > 3 else "Energy_sequences.txt"
+
+    score_sequences(gamma_file_name, decoys_file_name, energy_file_name)
@@ -11,7 +11,12 @@ import math
 import sys
 import numpy as np
 import mdtraj as md
-import itertools
+
+from scipy.spatial import cKDTree
+
+# The residue order of the phi code is read with read_pdb_arrays, from the common functions next to this folder;
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../common_functions'))
+from common_function import read_pdb_arrays
 
 ################################################
 
@@ -29,52 +34,75 @@ def my_le_range(start, end, step):
 #############################################
 
 
+RNA_resnames = ['A', 'C', 'G', 'U']
+prot_resnames = ['ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLU', 'GLN', 'GLY', 'HIS', 'ILE',
+                 'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL']
+
+
+def find_contacting_residue_pairs(pdb, cutoff, resnames_1, resnames_2):
+    # Same contacts as md.compute_contacts(scheme='closest-heavy') over all pairs of residues of resnames_1 and resnames_2,
+    # but only the heavy atoms within the cutoff (in nm) of each other are looked up, through a KD-tree of each group;
+    # Returns the (residue index 1, residue index 2) pairs in contact, and the distance of their closest heavy atoms;
+    atoms = list(pdb.topology.atoms)
+    atom_indices_1 = np.array([atom.index for atom in atoms if atom.residue.name in resnames_1 and atom.element != md.element.hydrogen], dtype=int)
+    atom_indices_2 = np.array([atom.index for atom in atoms if atom.residue.name in resnames_2 and atom.element != md.element.hydrogen], dtype=int)
+    atom_residues = np.array([atom.residue.index for atom in atoms], dtype=int)
+    if len(atom_indices_1) == 0 or len(atom_indices_2) == 0:
+        return np.zeros((0, 2), dtype=int), np.zeros(0)
+
+    coordinates = pdb.xyz[0].astype(float)
+    atom_pairs = cKDTree(coordinates[atom_indices_1]).sparse_distance_matrix(
+        cKDTree(coordinates[atom_indices_2]), cutoff, output_type='ndarray')
+    atom_pairs = atom_pairs[atom_pairs['v'] < cutoff]
+
+    residue_pairs = np.column_stack([atom_residues[atom_indices_1[atom_pairs['i']]],
+                                     atom_residues[atom_indices_2[atom_pairs['j']]]])
+    residue_pairs, pair_indices = np.unique(residue_pairs.reshape(-1, 2), axis=0, return_inverse=True)
+    respair_distances = np.full(len(residue_pairs), np.inf)
+    np.minimum.at(respair_distances, pair_indices.ravel(), atom_pairs['v'])
+    return residue_pairs, respair_distances
+
+
+def get_chain_ids(pdb):
+    return np.array([getattr(residue.chain, 'chain_id', None) or str(residue.chain.index)
+                     for residue in pdb.topology.residues], dtype=str)
+
+
+def get_sequence_positions(pdb, pdb_arrays):
+    # 1-indexed position of every residue in the sequence of the complex, i.e. in the residue order of get_res_list, which
+    # read_pdb_arrays follows (0 for the residues that get_res_list leaves out, e.g. HETATM records); the mdtraj residues of
+    # the first model are matched to it by chain and residue number, in file order for repeated numbers (insertion codes);
+    # unlike the resSeq, this position stays correct for multiple chains and for gaps in the numbering;
+    array_indices = {}
+    for i in np.flatnonzero(pdb_arrays['model_ids'] == pdb_arrays['model_ids'][0]):
+        array_indices.setdefault((pdb_arrays['chain_ids'][i], int(pdb_arrays['res_ids'][i])), []).append(i)
+    chain_ids = get_chain_ids(pdb)
+    sequence_positions = np.zeros(pdb.topology.n_residues, dtype=int)
+    for residue in pdb.topology.residues:
+        indices = array_indices.get((chain_ids[residue.index], residue.resSeq))
+        if indices:
+            sequence_positions[residue.index] = indices.pop(0) + 1
+    return sequence_positions
+
+
 def find_cm_residues(pdbfile, cutoff, random_position_file_protein, random_position_file_RNA):
 
     # Load the PDB
     pdb = md.load_pdb(pdbfile)
-    # Convert into a pandas table
-    pdb_table, pdb_bonds = pdb.topology.to_dataframe()
-
- #   print(pdb_table)
-
-    # Select residue indices belonging to RNA
-    RNA_resID = pdb_table.loc[(pdb_table['resName'] == 'A') |  (pdb_table['resName'] == 'C') | (pdb_table['resName'] == 'U') | (pdb_table['resName'] == 'G')].drop_duplicates(subset=['resSeq']).resSeq.to_numpy()
-    # Select residue indices belonging to protein
-    prot_resID = pdb_table.loc[(pdb_table['resName'] == 'ALA') |  (pdb_table['resName'] == 'ARG') | (pdb_table['resName'] == 'ASN') \
-         | (pdb_table['resName'] == 'ASP') | (pdb_table['resName'] == 'CYS') | (pdb_table['resName'] == 'GLU') \
-            | (pdb_table['resName'] == 'GLN') | (pdb_table['resName'] == 'GLY') | (pdb_table['resName'] == 'HIS') \
-                | (pdb_table['resName'] == 'ILE') | (pdb_table['resName'] == 'LEU') | (pdb_table['resName'] == 'LYS') \
-                    | (pdb_table['resName'] == 'MET') | (pdb_table['resName'] == 'PHE') | (pdb_table['resName'] == 'PRO') \
-                        | (pdb_table['resName'] == 'SER') | (pdb_table['resName'] == 'THR') | (pdb_table['resName'] == 'TRP') \
-                            | (pdb_table['resName'] == 'TYR') | (pdb_table['resName'] == 'VAL')].drop_duplicates(subset=['resSeq']).resSeq.to_numpy()
-    # For mdtraj requirement, made it into 0-indexed
-    RNA_resID_0_indexed = RNA_resID - 1
-    prot_resID_0_indexed = prot_resID - 1
-
-    # Select the atom indices belong to RNA
-    RNA_atom_indices = pdb.topology.select("resname =~ '[AUCG]'")
-    # Select the atom indices belong to protein
-    prot_atom_indices = pdb.topology.select("is_protein == True")
-
-    # Use mdtraj to calculate the contacts
-    prot_RNA_respairs = list(itertools.product(RNA_resID_0_indexed, prot_resID_0_indexed))
- #   print(prot_RNA_respairs)
-    prot_RNA_respair_distances, residue_pairs = md.compute_contacts(pdb, prot_RNA_respairs, scheme='closest-heavy')
-
-  #  print(prot_RNA_respair_distances)
-  #  print(residue_pairs)
-
-    # Select those pairs that are closer than the cutoff
-    prot_RNA_respair_distances = prot_RNA_respair_distances.flatten()
-    cm_pair_idx = np.argwhere(prot_RNA_respair_distances < cutoff).flatten()
-
-    # Recover the 1-indexed protein and RNA residue IDs that are in contact
-    prot_cm_resID = []
-    RNA_cm_resID = []
-    for i in cm_pair_idx:
-        RNA_cm_resID = np.append(RNA_cm_resID, prot_RNA_respairs[i][0] + 1)
-        prot_cm_resID = np.append(prot_cm_resID, prot_RNA_respairs[i][1] + 1)
+
+    # Find the RNA-protein residue pairs, over every pair of RNA and protein chains, whose closest heavy atoms are
+    # closer than the cutoff
+    residue_pairs, respair_distances = find_contacting_residue_pairs(pdb, cutoff, RNA_resnames, prot_resnames)
+
+    # Recover the positions in the complex sequence of the protein and RNA residues that are in contact; every one of them
+    # must be a residue of the phi code, or its decoys would randomize another residue
+    sequence_positions = get_sequence_positions(pdb, read_pdb_arrays(pdbfile))
+    RNA_cm_resID = sequence_positions[residue_pairs[:, 0]]
+    prot_cm_resID = sequence_positions[residue_pairs[:, 1]]
+    unmatched_residues = [residue for residue in np.unique(residue_pairs) if sequence_positions[residue] == 0]
+    if len(unmatched_residues) > 0:
+        raise ValueError("Contacting residue %s of %s is not in the residue list of the phi code" % (
+            pdb.topology.residue(unmatched_residues[0]), pdbfile))
 
     # Remove the duplicated residue IDs
     prot_cm_resID = np.unique(prot_cm_resID).astype(int)
@@ -89,16 +117,36 @@ def find_cm_residues(pdbfile, cutoff, random_position_file_protein, random_posit
 
     return
 
+
+def find_cm_residues_batch(complexes_file, cutoff):
+    # Batch mode: each line of complexes_file is "pdbfile random_position_file_protein random_position_file_RNA";
+    # all complexes are done in this one process, so that python and mdtraj are only loaded once;
+    with open(complexes_file, 'r') as input_file:
+        for line in input_file:
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            pdbfile, random_position_file_protein, random_position_file_RNA = fields
+            find_cm_residues(pdbfile, cutoff, random_position_file_protein, random_position_file_RNA)
+            print("Found the contacting residues of %s" % pdbfile)
+
 ############################################################################
 
 if __name__ == "__main__":
-    pdbfile = sys.argv[1]
-    # Cutoff for determining residue contacts
-    cutoff = float(sys.argv[2])
-    # files for recording indicies
-    random_position_file_protein = sys.argv[3]
-    random_position_file_RNA = sys.argv[4]
-
-    find_cm_residues(pdbfile, cutoff, random_position_file_protein, random_position_file_RNA)
+    # python find_cm_residues.py pdbfile cutoff random_position_file_protein random_position_file_RNA
+    # python find_cm_residues.py --batch complexes_file cutoff
+    if sys.argv[1] == "--batch":
+        complexes_file = sys.argv[2]
+        cutoff = float(sys.argv[3])
+        find_cm_residues_batch(complexes_file, cutoff)
+    else:
+        pdbfile = sys.argv[1]
+        # Cutoff for determining residue contacts
+        cutoff = float(sys.argv[2])
+        # files for recording indicies
+        random_position_file_protein = sys.argv[3]
+        random_position_file_RNA = sys.argv[4]
+
+        find_cm_residues(pdbfile, cutoff, random_position_file_protein, random_position_file_RNA)
  
     print("I slept and dreamt that life was joy. I awoke and saw that life was service. I acted and behold, service was joy.")
@@ -8,8 +8,10 @@
 
 cd for_bindingE/
 
-# Run to generate phi file
-bash cmd.for_phi.sh
+# Run to generate phi file, one complex per core (set --num_workers to limit it);
+# cmd.for_phi.sh runs the same pipeline serially
+python run_phi_pipeline.py proteinList.txt
+#bash cmd.for_phi.sh
 
 # Copy the generated phi into the loocv folder
 cd loocv/
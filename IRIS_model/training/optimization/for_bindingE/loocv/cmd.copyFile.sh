@@ -19,8 +19,12 @@ do
     cp ../$f/native_structures_pdbs_with_virtual_cbs/native.pdb native_structures_pdbs_with_virtual_cbs/${f}.pdb
 
     # 根据提取的params更改文件名
-    cp ../$f/phis/phi_pairwise_contact_well_native_Rmodified_native_${params} phis/phi_pairwise_contact_well_${f}_native_${params}
-    cp ../$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params} phis/phi_pairwise_contact_well_${f}_decoys_CPLEX_randomization_${params}
+    cp ../$f/phis/phi_pairwise_contact_well_native_Rmodified_native_${params}.phi phis/phi_pairwise_contact_well_${f}_native_${params}.phi
+    cp ../$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params}.phi phis/phi_pairwise_contact_well_${f}_decoys_CPLEX_randomization_${params}.phi
+    # Multiplicity weights of the decoys, if they were generated as unique decoys
+    if [ -f ../$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params}.weights ]; then
+        cp ../$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params}.weights phis/phi_pairwise_contact_well_${f}_decoys_CPLEX_randomization_${params}.weights
+    fi
     cp ../$f/tms/native_Rmodified.tm tms/${f}.tm
 done < proteinList.txt
 
@@ -0,0 +1,210 @@
+####################################################################################
+# This script runs the per-complex preprocessing and phi evaluation of cmd.for_phi.sh
+# for every complex of proteinList.txt, on a pool of worker processes
+#
+# Usage: python run_phi_pipeline.py [proteinList.txt] [--num_workers N]
+####################################################################################
+
+import argparse
+import contextlib
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from multiprocessing import Pool
+
+################################################
+
+
+def read_protein_list(protein_list_file_name):
+    protein_list = []
+    with open(protein_list_file_name, 'r') as protein_list_file:
+        for line in protein_list_file:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            protein_list.append(line)
+    return protein_list
+
+
+def run_stage(stage_timings, stage_name, command, cwd, log_file, env=None):
+    log_file.write("### %s: %s\n" % (stage_name, ' '.join(command)))
+    log_file.flush()
+    start_time = time.time()
+    subprocess.run(command, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT, env=env, check=True)
+    stage_timings.append((stage_name, time.time() - start_time))
+
+
+# The evaluate_phi functions are loaded once per worker process and then evaluate every complex that the worker gets,
+# with its chain passed as data, instead of a gsed-generated evaluate_phi.py and a new python process per complex;
+template_evaluate_phi = None
+
+
+def get_template_evaluate_phi(template_directory):
+    global template_evaluate_phi
+    if template_evaluate_phi is None:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../common_functions"))
+        module_spec = importlib.util.spec_from_file_location("template_evaluate_phi", os.path.join(template_directory, "template_evaluate_phi.py"))
+        template_evaluate_phi = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(template_evaluate_phi)
+    return template_evaluate_phi
+
+
+def evaluate_phis_in_directory(protein, partner_chains, template_directory):
+    # The phis are evaluated with paths relative to the folder of the complex, in this worker only, since the other
+    # cores run the other complexes;
+    evaluate_phi = get_template_evaluate_phi(template_directory)
+    current_directory = os.getcwd()
+    os.chdir(protein)
+    try:
+        evaluate_phi.evaluate_phis_for_complex(protein, partner_chains=partner_chains, num_processors=1)
+    finally:
+        os.chdir(current_directory)
+
+
+def find_contact_sites(protein_list, pdbs_directory, template_directory, contact_cutoff, contact_sites_directory):
+    # Find the contacting residues of all complexes in one find_cm_residues.py process, which the complexes then copy
+    # into their sequences folder instead of loading mdtraj once each; returns the time it took, or None if it failed;
+    start_time = time.time()
+    complexes_file_name = os.path.join(contact_sites_directory, "complexes.txt")
+    os.makedirs(contact_sites_directory, exist_ok=True)
+    with open(complexes_file_name, 'w') as complexes_file:
+        for protein in protein_list:
+            os.makedirs(os.path.join(contact_sites_directory, protein), exist_ok=True)
+            complexes_file.write("%s %s %s\n" % (os.path.join(pdbs_directory, "%s_modified.pdb" % protein),
+                                                 os.path.join(contact_sites_directory, protein, "randomize_position_prot.txt"),
+                                                 os.path.join(contact_sites_directory, protein, "randomize_position_RNA.txt")))
+
+    with open(os.path.join(contact_sites_directory, "find_cm_residues.log"), 'w') as log_file:
+        result = subprocess.run([sys.executable, os.path.join(template_directory, "sequences", "find_cm_residues.py"), "--batch",
+                                 complexes_file_name, str(contact_cutoff)], stdout=log_file, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        # The complexes that are missing their files find their contacts themselves in cmd.preprocessing.sh;
+        print("find_cm_residues.py --batch failed, see %s" % os.path.join(contact_sites_directory, "find_cm_residues.log"))
+        return None
+    return time.time() - start_time
+
+
+def run_phi_pipeline_for_protein(protein, pdbs_directory, template_directory, blas_threads, contact_sites_directory=None):
+    # Every complex runs in its own copy of the template folder; the chain ID file is written there as well
+    # instead of the shared native.pdb/chain_ID_protein.txt of cmd.for_phi.sh, so that complexes can run at the same time;
+    stage_timings = []
+    start_time = time.time()
+    try:
+        if os.path.exists(protein):
+            shutil.rmtree(protein)
+        shutil.copytree(template_directory, protein, symlinks=True)
+        if contact_sites_directory is not None:
+            for file_name in ["randomize_position_prot.txt", "randomize_position_RNA.txt"]:
+                if os.path.exists(os.path.join(contact_sites_directory, protein, file_name)):
+                    shutil.copy(os.path.join(contact_sites_directory, protein, file_name), os.path.join(protein, "sequences"))
+        stage_timings.append(("copy_template", time.time() - start_time))
+
+        log_file_name = os.path.join(protein, "run_phi_pipeline.log")
+        with open(log_file_name, 'w') as log_file:
+            run_stage(stage_timings, "find_prot_chainID",
+                      [sys.executable, "find_prot_chainID.py", os.path.join(pdbs_directory, "%s_modified.pdb" % protein),
+                       os.path.join(protein, "chain_ID_protein.txt")], ".", log_file)
+            prot_chainID = open(os.path.join(protein, "chain_ID_protein.txt")).read().strip()
+
+            # update the cmd.optimization.sh file the PDB id of the corresponding PDB folder and the protein chain;
+            optimization_script = open("template_cmd.optimization.sh").read()
+            optimization_script = optimization_script.replace("PDBID", protein).replace("PROT_CHAIN_ID", prot_chainID)
+            open(os.path.join(protein, "cmd.optimization.sh"), 'w').write(optimization_script)
+
+            # Each worker is one process, so keep the BLAS/OpenMP threads of numpy from oversubscribing the cores; they are
+            # set in the worker as well, before it loads numpy for the phi evaluation;
+            for variable in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+                os.environ[variable] = str(blas_threads)
+            environment = dict(os.environ)
+            environment["EVALUATE_PHI"] = "0"
+            run_stage(stage_timings, "preprocessing", ["bash", "cmd.optimization.sh"], protein, log_file, env=environment)
+
+            log_file.write("### evaluate_phi: %s %s\n" % (protein, prot_chainID))
+            log_file.flush()
+            stage_start_time = time.time()
+            with contextlib.redirect_stdout(log_file):
+                evaluate_phis_in_directory(protein, prot_chainID.split(), os.path.abspath(template_directory))
+            stage_timings.append(("evaluate_phi", time.time() - stage_start_time))
+    except Exception as error:
+        # A failed complex is reported and the worker goes on with the next one, also when its phi evaluation fails;
+        return protein, stage_timings, time.time() - start_time, str(error)
+
+    return protein, stage_timings, time.time() - start_time, None
+
+
+def run_phi_pipeline_for_protein_star(arguments):
+    return run_phi_pipeline_for_protein(*arguments)
+
+
+def run_phi_pipeline(protein_list_file_name, num_workers=None, pdbs_directory="../../PDBs", template_directory="template",
+                     blas_threads=1, timings_file_name="run_phi_pipeline_timings.txt", contact_cutoff=1.50,
+                     contact_sites_directory="contact_sites"):
+    protein_list = read_protein_list(protein_list_file_name)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = max(1, min(int(num_workers), len(protein_list)))
+    print("Running %d complexes on %d workers" % (len(protein_list), num_workers))
+
+    results = {}
+    start_time = time.time()
+    contact_sites_time = None
+    if contact_cutoff is not None:
+        if os.path.exists(contact_sites_directory):
+            shutil.rmtree(contact_sites_directory)
+        contact_sites_time = find_contact_sites(protein_list, pdbs_directory, template_directory, contact_cutoff, contact_sites_directory)
+        if contact_sites_time is not None:
+            print("Found the contacting residues of %d complexes in %.1f s" % (len(protein_list), contact_sites_time))
+
+    arguments_list = [(protein, pdbs_directory, template_directory, blas_threads, contact_sites_directory if contact_cutoff is not None else None)
+                      for protein in protein_list]
+    pool = Pool(num_workers)
+    try:
+        # The complexes finish in any order; report each as soon as it is done;
+        for protein, stage_timings, total_time, error in pool.imap_unordered(run_phi_pipeline_for_protein_star, arguments_list):
+            results[protein] = (stage_timings, total_time, error)
+            status = "FAILED (%s)" % error if error else "done"
+            print("%s %s in %.1f s: %s" % (protein, status, total_time,
+                                             ', '.join(["%s %.1f s" % stage_timing for stage_timing in stage_timings])))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    # Write the per-stage timings in the order of proteinList.txt;
+    with open(timings_file_name, 'w') as timings_file:
+        timings_file.write("# protein stage seconds\n")
+        if contact_sites_time is not None:
+            timings_file.write("%s %s %.3f\n" % ("all", "find_cm_residues_batch", contact_sites_time))
+        for protein in protein_list:
+            stage_timings, total_time, error = results[protein]
+            for stage_name, stage_time in stage_timings:
+                timings_file.write("%s %s %.3f\n" % (protein, stage_name, stage_time))
+            timings_file.write("%s %s %.3f\n" % (protein, "failed" if error else "total", total_time))
+
+    failed_proteins = [protein for protein in protein_list if results[protein][2]]
+    print("Finished %d complexes in %.1f s, %d failed%s" % (len(protein_list), time.time() - start_time, len(failed_proteins),
+                                                        (": " + ' '.join(failed_proteins)) if failed_proteins else ""))
+    return failed_proteins
+
+############################################################################
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the preprocessing and phi evaluation of every complex in parallel.")
+    parser.add_argument("protein_list_file_name", nargs='?', default="proteinList.txt")
+    parser.add_argument("--num_workers", type=int, default=None, help="number of complexes run at the same time (default: all cores)")
+    parser.add_argument("--pdbs_directory", default="../../PDBs")
+    parser.add_argument("--template_directory", default="template")
+    parser.add_argument("--blas_threads", type=int, default=1, help="BLAS/OpenMP threads of each complex")
+    parser.add_argument("--contact_cutoff", type=float, default=1.50,
+                        help="cutoff (in nm) of the contacting residues, found for all complexes at once; set it to the cutoff of cmd.preprocessing.sh")
+    args = parser.parse_args()
+
+    failed_proteins = run_phi_pipeline(args.protein_list_file_name, num_workers=args.num_workers, pdbs_directory=args.pdbs_directory,
+                                       template_directory=args.template_directory, blas_threads=args.blas_threads,
+                                       contact_cutoff=args.contact_cutoff)
+    sys.exit(1 if failed_proteins else 0)
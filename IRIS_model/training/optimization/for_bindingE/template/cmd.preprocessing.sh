@@ -32,26 +32,39 @@ bash for_gBinder_sequences.sh
 # Adjust cutoff for determining contacting residues (in nm)
 export cutoff=1.50  # Adjusted for hydrogen bonding & stacking interactions
 
-python find_cm_residues.py native.pdb $cutoff randomize_position_prot.txt randomize_position_RNA.txt
+# run_phi_pipeline.py finds them for all complexes at once (find_cm_residues.py --batch) and copies them here
+if [ ! -f randomize_position_prot.txt ] || [ ! -f randomize_position_RNA.txt ]; then
+    python find_cm_residues.py native.pdb $cutoff randomize_position_prot.txt randomize_position_RNA.txt
+fi
+
+# Unique decoys with multiplicity weights are only generated with UNIQUE_DECOYS=1
+UNIQUE_DECOYS_FLAG=""
+if [ "${UNIQUE_DECOYS:-0}" != "0" ]; then
+    UNIQUE_DECOYS_FLAG="--unique"
+fi
 
 # Generate decoys for the RNA
 rm -rf RNA_randomization
 mkdir -p RNA_randomization 
 
 cp randomize_position_RNA.txt native.seq gBinder_sequences.txt RNA_randomization/
-python generate_decoy_seq_RNA.py
+python generate_decoy_seq_RNA.py $UNIQUE_DECOYS_FLAG
 
 # Generate decoys for the protein
 rm -rf prot_randomization
 mkdir -p prot_randomization 
 
 cp randomize_position_prot.txt native.seq gBinder_sequences.txt prot_randomization/
-python generate_decoy_seq_prot.py
+python generate_decoy_seq_prot.py $UNIQUE_DECOYS_FLAG
 
 # Combine the generated RNA and protein decoys together
 rm -rf CPLEX_randomization
 mkdir -p CPLEX_randomization
 cat RNA_randomization/native.decoys prot_randomization/native.decoys > CPLEX_randomization/native_Rmodified.decoys
+# The multiplicity weights of the unique decoys follow the same order
+if [ -f RNA_randomization/native.decoys.weights ] && [ -f prot_randomization/native.decoys.weights ]; then
+    cat RNA_randomization/native.decoys.weights prot_randomization/native.decoys.weights > CPLEX_randomization/native_Rmodified.decoys.weights
+fi
 
 cd ../
 
@@ -64,6 +77,8 @@ tot_resnum=$(awk 'END{print $6}' tmp.txt)
 
 python create_tms.py sequences/RNA_randomization/randomize_position_RNA.txt $tot_resnum
 
-# Generate and run evaluation script
-gsed "s/CPLEX_NAME/$PDBid/g; s/PROT_CHAIN/$protChain/g" template_evaluate_phi.py > evaluate_phi.py
-python evaluate_phi.py
\ No newline at end of file
+# Evaluate the phis with the complex and its protein chain given as arguments, instead of generating evaluate_phi.py;
+# run_phi_pipeline.py sets EVALUATE_PHI=0 and evaluates them in its worker process instead
+if [ "${EVALUATE_PHI:-1}" != "0" ]; then
+    python template_evaluate_phi.py $PDBid $protChain
+fi
\ No newline at end of file
@@ -40,7 +40,7 @@ def RepresentsFloat(s):
 ###########################################
 
 
-def generate_decoy_sequences(proteins_list_file_name, methods=['RNA_randomization'], num_decoys=[1000], randomSeed=None):
+def generate_decoy_sequences(proteins_list_file_name, methods=['RNA_randomization'], num_decoys=[1000], randomSeed=None, unique=False):
     protein_list = read_column_from_file(proteins_list_file_name, 1)
     
     decoys_root_directory = "./"
@@ -55,6 +55,13 @@ def generate_decoy_sequences(proteins_list_file_name, methods=['RNA_randomizatio
         os.chdir(method)
         for protein in protein_list:
             print(method, protein)
+
+            # Randomizations of the contacting residues are sampled for all decoys at once;
+            if method in randomization_methods:
+                # A random seed is provided if necessary for reproductibility of each protein
+                generate_randomized_decoy_sequences(protein, method, num_decoys[i], np.random.default_rng(randomSeed), unique=unique)
+                continue
+
             output_file = open("%s.decoys" % protein, 'w')
             
             # A random seed is provided if necessary for reproductibility of each protein
@@ -65,6 +72,42 @@ def generate_decoy_sequences(proteins_list_file_name, methods=['RNA_randomizatio
             output_file.close()
         os.chdir('..')
 
+# The randomize_position file and the residue alphabet of each randomization method;
+randomization_methods = {
+    'RNA_randomization': ("randomize_position_RNA.txt", "agcu"),
+    'prot_randomization': ("randomize_position_prot.txt", "ARNDCEQGHILKMFPSTWYV")
+}
+
+def generate_randomized_decoy_sequences(protein, method, num_decoys, random_generator, block_size=100000, unique=False):
+    # Read the native sequence, the randomized positions and the gBinder sequences once, then draw the residues of
+    # block_size decoys at a time and write each block to the decoy file in one pass;
+    # With unique, every decoy sequence is written once and its multiplicity is written to <protein>.decoys.weights;
+    # small randomization sites are then enumerated exhaustively instead of being sampled;
+    sequences_root_directory = "../"
+
+    with open("%s%s.seq" % (sequences_root_directory + method + '/', protein), "r") as sequence_file:
+        native_sequence = sequence_file.read().replace('\n', '')
+    positions_file_name, alphabet = randomization_methods[method]
+    positions = read_randomize_positions(positions_file_name)
+    # Check and exclude those decoy sequences that coincide with the gBinder sequences, because we don't want good Binders
+    # to be treated as weak binders in our training processes; the gBinders are packed into integer codes once, and
+    # decoys that hit one are drawn again, so that num_decoys decoys are always written;
+    gBinder_codes = get_excluded_sequence_codes(native_sequence, open("gBinder_sequences.txt", 'r').read().splitlines(),
+                                                positions, alphabet)
+
+    if unique:
+        decoy_sequences, decoy_weights = get_unique_randomized_sequences(native_sequence, positions, alphabet, num_decoys,
+                                                                         random_generator, excluded_codes=gBinder_codes)
+        with open("%s.decoys" % protein, 'wb') as output_file:
+            write_sequence_array(output_file, decoy_sequences)
+        write_decoy_weights("%s.decoys.weights" % protein, decoy_weights)
+        return
+
+    with open("%s.decoys" % protein, 'wb') as output_file:
+        for decoy_sequences in iterate_randomized_sequence_blocks(native_sequence, positions, alphabet, num_decoys, random_generator,
+                                                                  excluded_codes=gBinder_codes, block_size=block_size):
+            write_sequence_array(output_file, decoy_sequences)
+
 def generate_decoy_sequence(protein, method='RNA_randomization', degree=None):
 
     sequences_root_directory = "../"
@@ -125,7 +168,7 @@ def generate_decoy_sequence(protein, method='RNA_randomization', degree=None):
         gBinder_sequences = open(
             "gBinder_sequences.txt", 'r').read().splitlines()
         if newsequence in gBinder_sequences:
-            return
+            return generate_decoy_sequence(protein, method=method, degree=degree)
         else:
             return newsequence
     elif method == 'prot_randomization':
@@ -146,7 +189,7 @@ def generate_decoy_sequence(protein, method='RNA_randomization', degree=None):
         gBinder_sequences = open(
             "gBinder_sequences.txt", 'r').read().splitlines()
         if newsequence in gBinder_sequences:
-            return
+            return generate_decoy_sequence(protein, method=method, degree=degree)
         else:
             return newsequence
 
@@ -154,4 +197,7 @@ def generate_decoy_sequence(protein, method='RNA_randomization', degree=None):
 ############################################
 
 
-generate_decoy_sequences("proteins_list.txt", methods=['prot_randomization'], num_decoys=[0], randomSeed=0)
+# python generate_decoy_seq_prot.py [--unique]
+# With --unique, every distinct decoy is written once and its multiplicity goes to <protein>.decoys.weights (if the
+# site has at most num_decoys sequences, all of them are enumerated); by default, num_decoys decoys are drawn independently;
+generate_decoy_sequences("proteins_list.txt", methods=['prot_randomization'], num_decoys=[0], randomSeed=0, unique="--unique" in sys.argv[1:])
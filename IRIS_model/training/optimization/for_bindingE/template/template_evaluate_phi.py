@@ -9,6 +9,7 @@ import subprocess
 import os
 import time
 import sys
+import functools
 
 import numpy as np
 
@@ -40,138 +41,300 @@ def RepresentsFloat(s):
 ###########################################
 
 
-def phi_pairwise_contact_well(res_list_tmonly, res_list_entire, neighbor_list, parameter_list, CPLEXmodeling=False, CPLEX_name='IDK'):
+def phi_pairwise_contact_well(res_list_tmonly, res_list_entire, neighbor_list, parameter_list, CPLEXmodeling=False, CPLEX_name='IDK', partner_chains=None):
+    # The phis sum the well weights of the contacting pairs onto the types of their two residues; the residue types
+    # are read once into an array, since decoys change them through mutate_whole_sequence; only the residues of the pairs
+    # are typed, so residues that never contact a partner may have any name;
+    res1_indices, res2_indices, weights = phi_pairwise_contact_well_pairs(
+        res_list_tmonly, res_list_entire, neighbor_list, parameter_list, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
+    res_types = get_res_types(res_list_entire, np.unique(np.concatenate((res1_indices, res2_indices))))
+    phis_to_return = get_phis_from_contact_pairs(res_types, res1_indices, res2_indices, weights)
 
+    return phis_to_return.tolist()
+
+
+def phi_pairwise_contact_well_pairs(res_list_tmonly, res_list_entire, neighbor_list, parameter_list, CPLEXmodeling=False, CPLEX_name='IDK', partner_chains=None):
+    # The pairs of parsed residues, searched among the atoms of neighbor_list;
+    return phi_pairwise_contact_well_pairs_from_arrays(get_pdb_arrays(res_list_entire, neighbor_list.atom_list), get_tm_mask(res_list_tmonly, res_list_entire),
+                                                       parameter_list, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
+
+
+def phi_pairwise_contact_well_pairs_from_arrays(pdb_arrays, tm_mask, parameter_list, CPLEXmodeling=False, CPLEX_name='IDK', partner_chains=None):
+    # Decoys only mutate the residue names and never move the atoms, so the contacting pairs and their well weights
+    # are the same for every decoy of a complex; they only need the PDB arrays, so no structure has to be parsed;
+    # the distances and well weights of all pairs are computed at once from the interaction-atom coordinate array;
     r_min, r_max, kappa, min_seq_sep = parameter_list
     r_min = float(r_min)
     r_max = float(r_max)
     kappa = float(kappa)
     min_seq_sep = int(min_seq_sep)
-    phi_pairwise_contact_well = np.zeros((24, 24))
-    for res1globalindex, res1 in enumerate(res_list_entire):
-
-        res1index = get_local_index(res1)
-        res1chain = get_chain(res1)
+    partner_chains = get_partner_chains(CPLEX_name, partner_chains, CPLEXmodeling=CPLEXmodeling)
+    interaction_coords = pdb_arrays['interaction_coords']
+    # Only the residues that are scored need an interaction atom (and a residue type, for the residues of the pairs);
+    check_pdb_arrays_residues(pdb_arrays, np.flatnonzero(tm_mask) if CPLEXmodeling else np.arange(len(tm_mask)))
+    neighbor_search = get_pdb_neighbor_search(pdb_arrays)
+    atom_residue_indices = pdb_arrays['atom_residue_indices']
+    chain_ids = pdb_arrays['chain_ids']
+    local_indices = pdb_arrays['res_ids']
+    res1_indices = []
+    res2_indices = []
+    for res1globalindex in range(len(local_indices)):
+
+        res1index = local_indices[res1globalindex]
+        res1chain = chain_ids[res1globalindex]
 
         # For CPLEX modeling, we only need the sequence in the DNA;
-        if CPLEXmodeling:
-            if (res1 in res_list_tmonly):
-                for res2 in get_neighbors_within_radius(neighbor_list, res1, r_max + 2.0):
-                    res2index = get_local_index(res2)
-                    res2chain = get_chain(res2)
-                    res2globalindex = get_global_index(res_list_entire, res2)
-                    # Here, we strictly consider only between the DNA chain and the protein chain:
-                    # Res1 through tm_only, is already in the DNA chain, we only need to control the res2 to
-                    # be in the protein chain;
-                    # The chain ID varies from one Complex to the other, be careful!!!
-                    if (CPLEX_name == 'CPLEX_NAME'):                       
-                        if (res2chain == 'PROT_CHAIN'):
-                            res1type = get_res_type(res_list_entire, res1)
-                            res2type = get_res_type(res_list_entire, res2)
-                            rij = get_interaction_distance(res1, res2)
-                            phi_pairwise_contact_well[res1type][res2type] += interaction_well(
-                                rij, r_min, r_max, kappa)
-                            if not res1type == res2type:
-                                phi_pairwise_contact_well[res2type][res1type] += interaction_well(
-                                    rij, r_min, r_max, kappa)
-
-            else:
-                continue
-
-        else:
+        if CPLEXmodeling and not tm_mask[res1globalindex]:
+            continue
+
+        for res2globalindex in get_neighbor_residue_indices(neighbor_search, atom_residue_indices, interaction_coords[res1globalindex], r_max + 2.0):
+            res2index = local_indices[res2globalindex]
+            res2chain = chain_ids[res2globalindex]
+            if CPLEXmodeling:
+                # Here, we strictly consider only between the DNA chain and the protein chain:
+                # Res1 through tm_only, is already in the DNA chain, we only need to control the res2 to
+                # be in one of the partner (protein) chains;
+                if res2chain not in partner_chains:
+                    continue
             # This is only for the AWSEM protein treatment, not related here;
-            for res2 in get_neighbors_within_radius(neighbor_list, res1, r_max + 2.0):
-                res2index = get_local_index(res2)
-                res2chain = get_chain(res2)
-                res2globalindex = get_global_index(res_list_entire, res2)
-                if (res1chain == res2chain and res2index - res1index >= min_seq_sep) or (res1chain != res2chain and res2globalindex > res1globalindex):
-                    res1type = get_res_type(res_list_entire, res1)
-                    res2type = get_res_type(res_list_entire, res2)
-                    rij = get_interaction_distance(res1, res2)
-                    phi_pairwise_contact_well[res1type][res2type] += interaction_well(
-                        rij, r_min, r_max, kappa)
-                    if not res1type == res2type:
-                        phi_pairwise_contact_well[res2type][res1type] += interaction_well(
-                            rij, r_min, r_max, kappa)
-
-    phis_to_return = []
-    for i in range(24):
-        for j in range(i, 24):
-            phis_to_return.append(phi_pairwise_contact_well[i][j])
-
-    return phis_to_return
-
-
-def evaluate_phis_over_training_set(training_set_file, phi_list_file_name, decoy_method, max_decoys, tm_only=False, num_processors=1, CPLEXmodeling=False, CPLEX_name='IDK'):
+            elif not ((res1chain == res2chain and res2index - res1index >= min_seq_sep) or (res1chain != res2chain and res2globalindex > res1globalindex)):
+                continue
+            res1_indices.append(res1globalindex)
+            res2_indices.append(res2globalindex)
+
+    res1_indices = np.array(res1_indices, dtype=int)
+    res2_indices = np.array(res2_indices, dtype=int)
+    check_pdb_arrays_residues(pdb_arrays, np.unique(np.concatenate((res1_indices, res2_indices))), check_res_types=True)
+    rij = get_interaction_distances(interaction_coords, res1_indices, res2_indices)
+    weights = np.asarray(interaction_well(rij, r_min, r_max, kappa), dtype=float)
+
+    return res1_indices, res2_indices, weights
+
+
+def get_partner_chains(CPLEX_name, partner_chains=None, CPLEXmodeling=True):
+    # The chains of the partner (protein) residues that the CPLEX modeling pairs with the tm residues; the chain ID
+    # varies from one complex to the other, so it is given as data (e.g. the chains written by find_prot_chainID.py);
+    # without it, this falls back to the single complex and chain substituted into evaluate_phi.py by gsed, and
+    # raises if the template was not substituted or CPLEX_name is another complex; only CPLEX modeling needs them;
+    if partner_chains is not None:
+        return list(partner_chains)
+    if not CPLEXmodeling:
+        return []
+    substituted_chains = ['PROT_CHAIN']
+    if CPLEX_name == 'CPLEX_NAME' and substituted_chains != ['PROT' + '_CHAIN']:
+        return substituted_chains
+    raise ValueError("No partner chains given for complex %s; pass partner_chains, or run the evaluate_phi.py generated by gsed" % CPLEX_name)
+
+
+def evaluate_phis_over_training_set(training_set_file, phi_list_file_name, decoy_method, max_decoys, tm_only=False, num_processors=1, CPLEXmodeling=False, CPLEX_name='IDK', partner_chains=None, batch_size=None, write_text_phis=False):
     phi_list = read_phi_list(phi_list_file_name)
     print(phi_list)
     training_set = read_column_from_file(training_set_file, 1)
     print(training_set)
 
     # for protein in training_set:
-    evaluate_phis_for_protein(training_set, phi_list, decoy_method, max_decoys, tm_only=tm_only, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name)
-
-
-def evaluate_phis_for_protein(training_set, phi_list, decoy_method, max_decoys, tm_only=False, CPLEXmodeling=False, CPLEX_name='IDK'):
+    evaluate_phis_for_protein(training_set, phi_list, decoy_method, max_decoys, tm_only=tm_only, num_processors=num_processors,
+                              CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains, batch_size=batch_size, write_text_phis=write_text_phis)
+
+
+def get_structure_artifact(protein, phi, parameters, CPLEXmodeling=False, CPLEX_name='IDK', partner_chains=None):
+    # Load the cached structure artifact of the complex for this phi, or build it from the PDB arrays if the PDB,
+    # the .tm file, the phi parameters or the chain selection have changed since it was written;
+    pdb_file_name = os.path.join(native_structures_directory, protein + '.pdb')
+    tm_file_name = os.path.join(tms_directory, protein + '.tm')
+    parameters_string = get_parameters_string(parameters)
+    artifact_file_name = get_structure_artifact_file_name(structure_artifacts_directory, protein, phi.__name__, parameters_string,
+                                                          pdb_file_name, tm_file_name)
+    selection = "%s %s %s" % (CPLEXmodeling, CPLEX_name, ','.join(get_partner_chains(CPLEX_name, partner_chains, CPLEXmodeling=CPLEXmodeling)))
+    if os.path.exists(artifact_file_name):
+        artifact = load_structure_artifact(artifact_file_name)
+        if str(artifact.get('selection')) == selection:
+            return artifact
+
+    pdb_arrays = load_pdb_arrays(pdb_file_name)
+    tm_mask = read_tm_mask(tm_file_name, len(pdb_arrays['res_ids']))
+
+    artifact = get_structure_arrays(pdb_arrays, tm_mask)
+    artifact['res1_indices'], artifact['res2_indices'], artifact['weights'] = globals()[phi.__name__ + '_pairs_from_arrays'](
+        pdb_arrays, tm_mask, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
+    artifact['selection'] = np.array(selection)
+    save_structure_artifact(artifact_file_name, artifact)
+    return artifact
+
+
+def evaluate_phis_for_protein(training_set, phi_list, decoy_method, max_decoys, tm_only=False, num_processors=1, CPLEXmodeling=False, CPLEX_name='IDK', partner_chains=None, batch_size=None, write_text_phis=False):
     # Because there is only one protein in the training set; if there are multiple proteins, the script could be different!
     protein = training_set[0]
 
     print(native_structures_directory)
-    structure = parse_pdb(os.path.join(native_structures_directory, protein))
-
-    # Two lists of res_list, one for the peptide (selected by the .tm file), one for the entire list
-    res_list_tmonly = get_res_list(structure, tm_only=True)
-    res_list_entire = get_res_list(structure, tm_only=False)
-    # Here, we are going to take every residues close to the pMHC peptide, so there is no restriction (tm_only) on what is going to be taken;
-    neighbor_list = get_neighbor_list(structure, tm_only=False)
-
-    sequence = get_sequence_from_structure(structure)
-
-    # Before the iteration, we need to store the native res_list_tmonly and res_list_entire; because after mutation for each phi, both of them 
-    # are changed afterwards to the decoy sequences; but we still need to evaluate the native phi for different phis;
-    res_list_tmonly_native = res_list_tmonly
-    res_list_entire_native = res_list_entire
+    # Phis that provide their contacting pairs are scored from the cached structure artifact, which is built from the
+    # PDB arrays, so the PDB is only parsed (by PDBParser) for the other phis;
+    structure = None
 
     for phi, parameters in phi_list:
 
         phi = globals()[phi]
         parameters_string = get_parameters_string(parameters)
-        # check to see if the decoys are already generated
-#        number_of_lines_in_file = get_number_of_lines_in_file(os.path.join(
-#            phis_directory, "%s_%s_native_%s" % (phi.__name__, protein, parameters_string)))
-#        if not number_of_lines_in_file >= 1:
-        output_file = open(os.path.join(phis_directory, "%s_%s_native_%s" % (
-            phi.__name__, protein, parameters_string)), 'w')
-        phis_to_write = phi(res_list_tmonly_native, res_list_entire_native,
-                            neighbor_list, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name)
-        output_file.write(str(phis_to_write).strip(
-            '[]').replace(',', '') + '\n')
-        output_file.close()
-#        number_of_lines_in_file = get_number_of_lines_in_file(os.path.join(
-#            phis_directory, "%s_%s_decoys_%s_%s" % (phi.__name__, protein, decoy_method, parameters_string)))
-#        if not number_of_lines_in_file >= max_decoys:
-        output_file = open(os.path.join(phis_directory, "%s_%s_decoys_%s_%s" % (
-            phi.__name__, protein, decoy_method, parameters_string)), 'w')
-        decoy_sequences = read_decoy_sequences(os.path.join(
-            decoys_root_directory, "%s/%s.decoys" % (decoy_method, protein)))
-        for i_decoy, decoy_sequence in enumerate(decoy_sequences):
-            if i_decoy >= max_decoys:
-                break
-            mutate_whole_sequence(res_list_entire, decoy_sequence)
-            # Note after this mutation, both res_list_entire and res_list_tmonly have been changed accordingly, because this is a change by reference;
-
-            phis_to_write = phi(res_list_tmonly, res_list_entire,
-                                neighbor_list, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name)
-            output_file.write(str(phis_to_write).strip(
-                '[]').replace(',', ' ') + '\n')
-        output_file.close()
+        decoy_sequences_file_name = os.path.join(decoys_root_directory, "%s/%s.decoys" % (decoy_method, protein))
+        native_file_name = os.path.join(phis_directory, "%s_%s_native_%s" % (
+            phi.__name__, protein, parameters_string))
+        decoys_file_name = os.path.join(phis_directory, "%s_%s_decoys_%s_%s" % (
+            phi.__name__, protein, decoy_method, parameters_string))
+        # Unique decoys come with their multiplicity weights, which are kept next to the decoy phis for the gamma optimization;
+        decoy_weights = read_decoy_weights(decoy_sequences_file_name + decoy_weights_extension, max_rows=max_decoys)
+        if decoy_weights is not None:
+            write_decoy_weights(decoys_file_name + decoy_weights_extension, decoy_weights)
+        elif os.path.exists(decoys_file_name + decoy_weights_extension):
+            os.remove(decoys_file_name + decoy_weights_extension)
+
+        # Reuse the phis of an earlier run (in this or any other folder) on the same PDB, .tm and decoy files with the same
+        # phi and parameters; setting IRIS_PHI_CACHE to an empty string turns the cache off;
+        output_file_names = {'native' + phi_store_extension: native_file_name + phi_store_extension,
+                             'decoys' + phi_store_extension: decoys_file_name + phi_store_extension}
+        if write_text_phis:
+            output_file_names['native'] = native_file_name
+            output_file_names['decoys'] = decoys_file_name
+        phi_cache_key = None
+        if phi_cache_directory:
+            phi_cache_key = get_phi_cache_key([os.path.join(native_structures_directory, protein + '.pdb'),
+                                               os.path.join(tms_directory, protein + '.tm'), decoy_sequences_file_name],
+                                              [phi.__name__, parameters_string, max_decoys, tm_only, CPLEXmodeling, CPLEX_name, ','.join(get_partner_chains(CPLEX_name, partner_chains, CPLEXmodeling=CPLEXmodeling))])
+            if load_phi_cache_entry(phi_cache_directory, phi_cache_key, output_file_names):
+                print("Reusing the cached phis %s for %s %s" % (phi_cache_key, protein, phi.__name__))
+                # The steps after evaluate_phi (sequence scoring, streamed decoys) read the structure artifact of this folder,
+                # so it is built (or loaded) here as well;
+                if globals().get(phi.__name__ + '_pairs') is not None:
+                    get_structure_artifact(protein, phi, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
+                continue
+
+        decoy_sequences = read_decoy_sequences(decoy_sequences_file_name)[:max_decoys]
+
+        if globals().get(phi.__name__ + '_pairs') is not None:
+            artifact = get_structure_artifact(protein, phi, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
+            phis_to_write = get_phis_from_contact_pairs(
+                artifact['res_types'], artifact['res1_indices'], artifact['res2_indices'], artifact['weights'])
+            evaluate_decoy_phis_block = functools.partial(evaluate_decoy_phis_from_contact_pairs,
+                artifact['res1_indices'], artifact['res2_indices'], artifact['weights'], len(artifact['res_types']),
+                batch_size=batch_size)
+        else:
+            if structure is None:
+                structure = parse_pdb(os.path.join(native_structures_directory, protein))
+
+                # Two lists of res_list, one for the peptide (selected by the .tm file), one for the entire list
+                res_list_tmonly = get_res_list(structure, tm_only=True)
+                res_list_entire = get_res_list(structure, tm_only=False)
+                # Here, we are going to take every residues close to the pMHC peptide, so there is no restriction (tm_only) on what is going to be taken;
+                neighbor_list = get_neighbor_list(structure, tm_only=False)
+
+                # Before the iteration, we need to store the native res_list_tmonly and res_list_entire; because after mutation for each phi, both of them 
+                # are changed afterwards to the decoy sequences; but we still need to evaluate the native phi for different phis;
+                res_list_tmonly_native = res_list_tmonly
+                res_list_entire_native = res_list_entire
+
+            phis_to_write = phi(res_list_tmonly_native, res_list_entire_native,
+                                neighbor_list, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
+            evaluate_decoy_phis_block = functools.partial(evaluate_decoy_phis, phi, parameters, res_list_tmonly=res_list_tmonly,
+                res_list_entire=res_list_entire, neighbor_list=neighbor_list, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains,
+                batch_size=batch_size)
+
+        write_phi_store(native_file_name, phi.__name__, parameters_string, phis_to_write)
+        if write_text_phis:
+            output_file = open(native_file_name, 'w')
+            append_phi_text(output_file, phis_to_write)
+            output_file.close()
+        phi_store_file = open_phi_store(decoys_file_name, phi.__name__, parameters_string, len(phis_to_write))
+        if write_text_phis:
+            output_file = open(decoys_file_name, 'w')
+        for phis_block in evaluate_decoy_phis_in_shards(evaluate_decoy_phis_block, decoy_sequences, num_processors=num_processors,
+                                                        shard_size=batch_size or 1000):
+            append_phi_store(phi_store_file, phis_block)
+            if write_text_phis:
+                append_phi_text(output_file, phis_block)
+        close_phi_store(phi_store_file)
+        if write_text_phis:
+            output_file.close()
+        if phi_cache_key is not None:
+            save_phi_cache_entry(phi_cache_directory, phi_cache_key, output_file_names, max_bytes=phi_cache_max_bytes)
+
+
+def evaluate_decoy_phis_in_shards(evaluate_decoy_phis_block, decoy_sequences, num_processors=1, shard_size=1000):
+    # Split the decoys into shards of shard_size sequences and evaluate them on num_processors processes; the workers
+    # get the geometry and the decoy sequences through get_pool_shared_data(), and the blocks come back in decoy order;
+    # no pool is started for a single shard, and never more processes than shards (num_processors=None: all cores);
+    shard_starts = list(range(0, len(decoy_sequences), shard_size))
+    num_processors = min(int(num_processors or os.cpu_count()), len(shard_starts))
+    if num_processors <= 1:
+        for phis_block in evaluate_decoy_phis_block(decoy_sequences=decoy_sequences):
+            yield phis_block
+        return
+
+    shard_ends = [shard_start + shard_size for shard_start in shard_starts]
+    for phis_block in iterate_independent_functions_on_n_processors(evaluate_decoy_phis_shard, [shard_starts, shard_ends], num_processors,
+                                                                    shared_data=(evaluate_decoy_phis_block, decoy_sequences)):
+        yield phis_block
+
+
+def evaluate_decoy_phis_shard(shard_start, shard_end):
+    evaluate_decoy_phis_block, decoy_sequences = get_pool_shared_data()
+    return np.vstack(list(evaluate_decoy_phis_block(decoy_sequences=decoy_sequences[shard_start:shard_end])))
+
+
+def evaluate_decoy_phis_from_contact_pairs(res1_indices, res2_indices, weights, num_residues, decoy_sequences, batch_size=None):
+    # Decoys only re-type the residues, so their phis follow from the contacting pairs of the native structure;
+    # In batch mode, a block of decoys is one-hot encoded and contracted with the pair weight matrix at once;
+    if batch_size:
+        contact_residues, pair_weight_matrix = get_pair_weight_matrix(res1_indices, res2_indices, weights)
+        for i_block in range(0, len(decoy_sequences), batch_size):
+            res_types_block = get_sequences_res_types(decoy_sequences[i_block:i_block + batch_size], num_residues)
+            yield get_phis_from_pair_weight_matrix(res_types_block[:, contact_residues], pair_weight_matrix)
+        return
+
+    for decoy_sequence in decoy_sequences:
+        res_types = get_sequence_res_types(decoy_sequence, num_residues)
+        yield get_phis_from_contact_pairs(res_types, res1_indices, res2_indices, weights)
+
+
+def evaluate_decoy_phis(phi, parameters, decoy_sequences, res_list_tmonly, res_list_entire, neighbor_list, CPLEXmodeling=False, CPLEX_name='IDK', partner_chains=None, batch_size=None):
+    # Yields the phis of the decoy sequences as blocks of rows, in the order of decoy_sequences;
+    # If the phi provides its contacting pairs, compute the geometry once and only re-type the residues per decoy;
+    phi_pairs = globals().get(phi.__name__ + '_pairs')
+    if phi_pairs is not None:
+        res1_indices, res2_indices, weights = phi_pairs(res_list_tmonly, res_list_entire,
+                                                        neighbor_list, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
+        for phis_block in evaluate_decoy_phis_from_contact_pairs(res1_indices, res2_indices, weights, len(res_list_entire),
+                                                                 decoy_sequences, batch_size=batch_size):
+            yield phis_block
+        return
+
+    for decoy_sequence in decoy_sequences:
+        mutate_whole_sequence(res_list_entire, decoy_sequence)
+        # Note after this mutation, both res_list_entire and res_list_tmonly have been changed accordingly, because this is a change by reference;
+
+        yield phi(res_list_tmonly, res_list_entire,
+                  neighbor_list, parameters, CPLEXmodeling=CPLEXmodeling, CPLEX_name=CPLEX_name, partner_chains=partner_chains)
 
 
 ############################################
 
 native_structures_directory = "./native_structures_pdbs_with_virtual_cbs/"
+tms_directory = "./tms/"
 phis_directory = "./phis/"
 decoys_root_directory = "./sequences/"
 
-evaluate_phis_over_training_set("proteins_list_forphi.txt", "phi1_list.txt", decoy_method='CPLEX_randomization', 
-                                max_decoys=10000, tm_only=False, num_processors=1, CPLEXmodeling=True, CPLEX_name='CPLEX_NAME')
+
+def evaluate_phis_for_complex(CPLEX_name, partner_chains=None, num_processors=None):
+    # Evaluate the phis of the complex in the current folder; with partner_chains, any number of complexes can be
+    # evaluated from one process (e.g. run_phi_pipeline.py), without generating an evaluate_phi.py for each of them;
+    # the decoys are evaluated on all cores, up to one process per shard, unless num_processors is given;
+    evaluate_phis_over_training_set("proteins_list_forphi.txt", "phi1_list.txt", decoy_method='CPLEX_randomization', 
+                                    max_decoys=10000, tm_only=False, num_processors=num_processors, CPLEXmodeling=True, CPLEX_name=CPLEX_name,
+                                    partner_chains=partner_chains, batch_size=10000)
+
+
+if __name__ == "__main__":
+    # python template_evaluate_phi.py CPLEX_name partner_chain [partner_chain ...]
+    # or, in the evaluate_phi.py generated by gsed, python evaluate_phi.py
+    if len(sys.argv) > 1:
+        evaluate_phis_for_complex(sys.argv[1], partner_chains=sys.argv[2:] or None)
+    else:
+        evaluate_phis_for_complex('CPLEX_NAME')
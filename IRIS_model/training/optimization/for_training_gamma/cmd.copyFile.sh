@@ -20,8 +20,12 @@ do
     cp ../for_bindingE/$f/native_structures_pdbs_with_virtual_cbs/native.pdb native_structures_pdbs_with_virtual_cbs/${f}.pdb
 
     # 根据提取的params更改文件名
-    cp ../for_bindingE/$f/phis/phi_pairwise_contact_well_native_Rmodified_native_${params} phis/phi_pairwise_contact_well_${f}_native_${params}
-    cp ../for_bindingE/$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params} phis/phi_pairwise_contact_well_${f}_decoys_CPLEX_randomization_${params}
+    cp ../for_bindingE/$f/phis/phi_pairwise_contact_well_native_Rmodified_native_${params}.phi phis/phi_pairwise_contact_well_${f}_native_${params}.phi
+    cp ../for_bindingE/$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params}.phi phis/phi_pairwise_contact_well_${f}_decoys_CPLEX_randomization_${params}.phi
+    # Multiplicity weights of the decoys, if they were generated as unique decoys
+    if [ -f ../for_bindingE/$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params}.weights ]; then
+        cp ../for_bindingE/$f/phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_${params}.weights phis/phi_pairwise_contact_well_${f}_decoys_CPLEX_randomization_${params}.weights
+    fi
     cp ../for_bindingE/$f/tms/native_Rmodified.tm tms/${f}.tm
 done < native_trainSetFiles.txt
 
@@ -12,6 +12,12 @@ import sys
 
 import numpy as np
 
+# threadpoolctl is only used to limit the number of BLAS threads of the Gram-matrix products;
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 
 sys.path.append('../../common_functions')
 from common_function import *
@@ -40,60 +46,75 @@ def RepresentsFloat(s):
 ###########################################
 
 
-def get_filtered_B_inv_lambda_and_P(filtered_lamb, cutoff_mode, P, method='extend_all_after_first_noisy_mode'):
+def get_filtered_lambda_and_lambda_inv(filtered_lamb, cutoff_mode, method='extend_all_after_first_noisy_mode'):
     if method == 'zero_all_after_first_noisy_mode':
         filtered_lamb_inv = 1 / filtered_lamb
         # for "zeroing unreliable eigenvalues"
         filtered_lamb_inv[cutoff_mode:] = 0.0
-        filtered_B_inv = np.dot(
-            P, np.dot(np.diag(filtered_lamb_inv), np.linalg.inv(P)))
-        filtered_lamb = 1 / filtered_lamb_inv
+        filtered_lamb[cutoff_mode:] = 0.0
     if method == 'extend_all_after_first_noisy_mode':
         # for "extending lowest reliable eigenvalue"
         filtered_lamb[cutoff_mode:] = filtered_lamb[cutoff_mode - 1]
-        filtered_B_inv = np.dot(
-            P, np.dot(np.diag(1 / filtered_lamb), np.linalg.inv(P)))
-
-    return filtered_B_inv, filtered_lamb, P
+        filtered_lamb_inv = 1 / filtered_lamb
 
-def get_filtered_gamma_B_lamb_P_and_lamb(A, B, half_B, other_half_B, std_half_B, total_phis, num_decoys, noise_iterations=10, relative_error_threshold=0.05):
-    lamb, P = np.linalg.eig(B)
+    return filtered_lamb, filtered_lamb_inv
+
+def get_noisy_cutoff_modes(lamb, half_B, other_half_B, std_half_B, num_decoys, noise_iterations=10, relative_error_threshold=0.05, batch_iterations=True, random_seed=None, rank_tolerance=1e-10):
+    # Resample the upper triangle of half_B within its decoy-sampling noise, and find for each noisy B the first
+    # eigenvalue that moves by more than relative_error_threshold; all perturbations of an iteration are drawn at once,
+    # and with batch_iterations the noisy matrices of all iterations are diagonalized as one stacked array;
+    # only the modes above the numerical rank of B (lamb > lamb[0] * rank_tolerance) are tested, so the cutoff never
+    # lands on an eigenvalue that is zero up to round-off;
+    random_generator = np.random.default_rng(random_seed)
+    total_phis = len(lamb)
+    num_reliable = max(1, int(np.count_nonzero(lamb > lamb[0] * rank_tolerance)))
+    upper_i, upper_j = np.triu_indices(total_phis)
+    loc = half_B[upper_i, upper_j]
+    scale = std_half_B[upper_i, upper_j] / float(num_decoys)
+
+    num_stacked = noise_iterations if batch_iterations else 1
+    cutoff_modes = []
+    for i_noise in range(0, noise_iterations, num_stacked):
+        num_noisy = min(num_stacked, noise_iterations - i_noise)
+        noisy_B_upper = random_generator.normal(loc=loc, scale=scale, size=(num_noisy, len(loc))) - \
+            other_half_B[upper_i, upper_j]
+        noisy_B = np.zeros((num_noisy, total_phis, total_phis))
+        noisy_B[:, upper_i, upper_j] = noisy_B_upper
+        noisy_B[:, upper_j, upper_i] = noisy_B_upper
+
+        # eigvalsh returns the eigenvalues in ascending order;
+        noisy_lamb = np.linalg.eigvalsh(noisy_B)[:, ::-1][:, :num_reliable]
+        noisy_modes = np.abs(lamb[:num_reliable] - noisy_lamb) / lamb[:num_reliable] > relative_error_threshold
+        for noisy_mode in noisy_modes:
+            cutoff_modes.append(int(np.argmax(noisy_mode)) if noisy_mode.any() else num_reliable)
+    return cutoff_modes
+
+
+def get_filtered_gamma_B_lamb_P_and_lamb(A, B, half_B, other_half_B, std_half_B, total_phis, num_decoys, noise_iterations=10, relative_error_threshold=0.05, cutoff_mode=None, random_seed=None):
+    # B is symmetric, so eigh gives real eigenvalues and orthonormal eigenvectors (P^-1 = P^T);
+    lamb, P = np.linalg.eigh(B)
     lamb, P = sort_eigenvalues_and_eigenvectors(lamb, P)
 
-    cutoff_modes = []
-    for i_noise in range(noise_iterations):
-        noisy_B = np.zeros((total_phis, total_phis))
-        for i in range(total_phis):
-            for j in range(i, total_phis):
-                random_B_ij = np.random.normal(
-                    loc=half_B[i][j], scale=std_half_B[i][j] / float(num_decoys))
-                noisy_B[i][j] = noisy_B[j][i] = random_B_ij - \
-                    other_half_B[i][j]
-
-        noisy_lamb, noisy_P = np.linalg.eig(noisy_B)
-        noisy_lamb, noisy_P = sort_eigenvalues_and_eigenvectors(
-            noisy_lamb, noisy_P)
-        
-        try:
-            cutoff_mode = np.where(np.abs(lamb - noisy_lamb) / lamb > relative_error_threshold)[0][0]
-        except IndexError:
-            cutoff_mode = len(lamb)
-        cutoff_modes.append(cutoff_mode)
-    
-    cutoff_mode = min(cutoff_modes)
-    # Hard set a cutoff_mode by looking at the Lamb file itself;
-    cutoff_mode = 25
-
-    print(cutoff_modes)
+    # The cutoff is the first mode that is unreliable in any of the noise iterations, unless it is hard set
+    # by looking at the Lamb file itself;
+    if cutoff_mode is None:
+        if noise_iterations < 1:
+            raise ValueError("noise_iterations must be at least 1 when cutoff_mode is not set")
+        cutoff_modes = get_noisy_cutoff_modes(lamb, half_B, other_half_B, std_half_B, num_decoys,
+                                              noise_iterations=noise_iterations, relative_error_threshold=relative_error_threshold,
+                                              random_seed=random_seed)
+        cutoff_mode = max(1, min(cutoff_modes))
+        print(cutoff_modes)
     print(cutoff_mode)
 
     filtered_lamb = np.copy(lamb)
     print(filtered_lamb[cutoff_mode - 1])
-    filtered_B_inv, filtered_lamb, P = get_filtered_B_inv_lambda_and_P(
-        filtered_lamb, cutoff_mode, P)
+    filtered_lamb, filtered_lamb_inv = get_filtered_lambda_and_lambda_inv(
+        filtered_lamb, cutoff_mode)
 
-    filtered_gamma = np.dot(filtered_B_inv, A)
-    filtered_B = np.linalg.inv(filtered_B_inv)
+    # Apply the filtered spectrum to A directly, P diag(1/lamb) P^T A, without forming or inverting filtered_B_inv;
+    filtered_gamma = np.dot(P, filtered_lamb_inv * np.dot(P.T, A))
+    filtered_B = np.dot(P * filtered_lamb, P.T)
     return filtered_gamma, filtered_B, filtered_lamb, P, lamb
 
 
@@ -125,7 +146,204 @@ def calculate_A_and_B_wei(average_phi_decoy, phi_native, all_phis):
 
     return A, B, half_B, other_half_B, std_half_B
 
-def calculate_A_B_and_gamma_xl23(training_set_file, phi_list_file_name, decoy_method, num_decoys, noise_filtering=True, jackhmmer=False):
+def calculate_A_and_B_streaming(phi_native, training_set, phi_list, total_phis, num_decoys, decoy_method, chunk_size=100, jackhmmer=False):
+    # Same A, B, half_B, other_half_B and std_half_B as calculate_A_and_B_wei, but the decoy phis are read from disk
+    # in chunks, and the mean and spread of phi_i * phi_j are merged chunk by chunk (Welford/Chan update),
+    # so the memory stays at O(chunk_size * total_phis^2) whatever the number of decoys;
+    half_B = np.zeros((total_phis, total_phis))
+    std_half_B = np.zeros((total_phis, total_phis))
+    other_half_B = np.zeros((total_phis, total_phis))
+    sum_phi_decoy = np.zeros(total_phis)
+    total_decoys = 0
+
+    for protein in training_set:
+        # Unique decoys count as many times as they were drawn; num_decoys_read is then the total weight read;
+        decoy_weights = read_decoy_phis_weights(protein, phi_list, num_decoys, decoy_method, jackhmmer=jackhmmer)
+        num_decoys_read = 0
+        num_rows_read = 0
+        mean_phi = np.zeros(total_phis)
+        mean_phi_phi = np.zeros((total_phis, total_phis))
+        m2_phi_phi = np.zeros((total_phis, total_phis))
+        for phis in read_decoy_phis_chunks(protein, phi_list, num_decoys, decoy_method, chunk_size, jackhmmer=jackhmmer):
+            num_rows = phis.shape[0]
+            if decoy_weights is None:
+                weights = np.ones(num_rows)
+            else:
+                weights = decoy_weights[num_rows_read:num_rows_read + num_rows]
+            num_rows_read += num_rows
+            num_chunk = np.sum(weights)
+            phi_phi = phis.reshape(num_rows, total_phis, 1) * phis.reshape(num_rows, 1, total_phis)
+            chunk_mean_phi_phi = np.average(phi_phi, axis=0, weights=weights)
+            chunk_m2_phi_phi = np.einsum('d,dij->ij', weights, (phi_phi - chunk_mean_phi_phi) ** 2)
+
+            num_merged = num_decoys_read + num_chunk
+            delta = chunk_mean_phi_phi - mean_phi_phi
+            mean_phi_phi += delta * num_chunk / num_merged
+            m2_phi_phi += chunk_m2_phi_phi + delta ** 2 * num_decoys_read * num_chunk / num_merged
+            mean_phi += (np.dot(weights, phis) - num_chunk * mean_phi) / num_merged
+            num_decoys_read = num_merged
+
+        half_B += mean_phi_phi
+        std_half_B += np.sqrt(m2_phi_phi / num_decoys_read)
+        other_half_B += mean_phi.reshape(total_phis, 1) * mean_phi.reshape(1, total_phis)
+        sum_phi_decoy += mean_phi * num_decoys_read
+        total_decoys += num_decoys_read
+
+    half_B /= len(training_set)
+    std_half_B /= len(training_set)
+    other_half_B /= len(training_set)
+
+    average_phi_decoy = sum_phi_decoy / total_decoys
+    A = average_phi_decoy - phi_native
+    B = half_B - other_half_B
+
+    return A, B, half_B, other_half_B, std_half_B, average_phi_decoy
+
+def get_chunk_phi_phi_moments(phis, weights):
+    # Mean and sum of squared deviations of phi_i * phi_j over a chunk of decoys, from Gram products only: with the phis
+    # centered on their chunk mean c, u = phis - c, phi_i * phi_j = c_i c_j + z_ij with z_ij = c_i u_j + c_j u_i + u_i u_j,
+    # and the moments of z are (u**2).T @ (u**2), (u**2).T @ u and u.T @ u; unlike E[(phi_i phi_j)**2] - E[phi_i phi_j]**2,
+    # the large c_i c_j never enters the subtraction, so the spread keeps its precision;
+    num_chunk = np.sum(weights)
+    mean_phi = (weights @ phis) / num_chunk
+    u = phis - mean_phi
+    u_squared = u ** 2
+    weighted_u = u * weights[:, None]
+    weighted_u_squared = u_squared * weights[:, None]
+    mean_u_u = (weighted_u.T @ u) / num_chunk
+    mean_u_u_squared = (weighted_u_squared.T @ u) / num_chunk
+    mean_u_squared_u_squared = (weighted_u_squared.T @ u_squared) / num_chunk
+    mean_u_squared = (weights @ u_squared) / num_chunk
+    mean_squared = mean_phi ** 2
+    # E[z_ij**2], of which E[z_ij] = E[u_i u_j];
+    mean_z_squared = (np.outer(mean_squared, mean_u_squared) + np.outer(mean_u_squared, mean_squared) + mean_u_squared_u_squared
+                      + 2 * np.outer(mean_phi, mean_phi) * mean_u_u + 2 * mean_phi[:, None] * mean_u_u_squared.T
+                      + 2 * mean_u_u_squared * mean_phi[None, :])
+    chunk_mean_phi_phi = np.outer(mean_phi, mean_phi) + mean_u_u
+    chunk_m2_phi_phi = np.maximum(mean_z_squared - mean_u_u ** 2, 0.0) * num_chunk
+    return num_chunk, chunk_mean_phi_phi, chunk_m2_phi_phi
+
+
+def calculate_A_and_B_gram(phi_native, training_set, phi_list, total_phis, num_decoys, decoy_method, chunk_size=10000, num_threads=None, jackhmmer=False, decoy_phis_generator=None):
+    # half_B is the Gram matrix X.T @ X / n of the decoy phi matrix X, so it is accumulated with BLAS products
+    # (numpy dispatches X.T @ X to SYRK) instead of averaging the broadcast outer products; std_half_B follows from
+    # the spread of phi_i * phi_j in each chunk (get_chunk_phi_phi_moments), merged chunk by chunk (Chan update)
+    # as in calculate_A_and_B_streaming;
+    if num_threads is not None:
+        if threadpool_limits is None:
+            raise ImportError("threadpoolctl is needed to limit the BLAS threads to %s; install it, or leave num_threads unset" % num_threads)
+        with threadpool_limits(limits=int(num_threads), user_api='blas'):
+            return calculate_A_and_B_gram(phi_native, training_set, phi_list, total_phis, num_decoys, decoy_method,
+                                          chunk_size=chunk_size, num_threads=None, jackhmmer=jackhmmer,
+                                          decoy_phis_generator=decoy_phis_generator)
+
+    half_B = np.zeros((total_phis, total_phis))
+    std_half_B = np.zeros((total_phis, total_phis))
+    other_half_B = np.zeros((total_phis, total_phis))
+    sum_phi_decoy = np.zeros(total_phis)
+    total_decoys = 0
+
+    for protein in training_set:
+        # Unique decoys count as many times as they were drawn: the Gram matrices are weighted with their multiplicities;
+        # In streaming mode the decoy phis come from decoy_phis_generator(protein) instead of the decoy phi files;
+        if decoy_phis_generator is None:
+            decoy_weights = read_decoy_phis_weights(protein, phi_list, num_decoys, decoy_method, jackhmmer=jackhmmer)
+            decoy_phis_chunks = read_decoy_phis_chunks(protein, phi_list, num_decoys, decoy_method, chunk_size, jackhmmer=jackhmmer)
+        else:
+            decoy_weights = None
+            decoy_phis_chunks = decoy_phis_generator(protein)
+        num_decoys_read = 0
+        num_rows_read = 0
+        sum_phi = np.zeros(total_phis)
+        sum_phi_phi = np.zeros((total_phis, total_phis))
+        merged_mean_phi_phi = np.zeros((total_phis, total_phis))
+        m2_phi_phi = np.zeros((total_phis, total_phis))
+        for phis in decoy_phis_chunks:
+            if decoy_weights is None:
+                weights = np.ones(phis.shape[0])
+                sum_phi += np.sum(phis, axis=0)
+                sum_phi_phi += phis.T @ phis
+            else:
+                weights = decoy_weights[num_rows_read:num_rows_read + phis.shape[0]]
+                sum_phi += weights @ phis
+                sum_phi_phi += (phis * weights[:, None]).T @ phis
+            num_rows_read += phis.shape[0]
+
+            num_chunk, chunk_mean_phi_phi, chunk_m2_phi_phi = get_chunk_phi_phi_moments(phis, weights)
+            num_merged = num_decoys_read + num_chunk
+            delta = chunk_mean_phi_phi - merged_mean_phi_phi
+            merged_mean_phi_phi += delta * num_chunk / num_merged
+            m2_phi_phi += chunk_m2_phi_phi + delta ** 2 * num_decoys_read * num_chunk / num_merged
+            num_decoys_read = num_merged
+
+        mean_phi = sum_phi / num_decoys_read
+        mean_phi_phi = sum_phi_phi / num_decoys_read
+        half_B += mean_phi_phi
+        std_half_B += np.sqrt(m2_phi_phi / num_decoys_read)
+        other_half_B += np.outer(mean_phi, mean_phi)
+        sum_phi_decoy += sum_phi
+        total_decoys += num_decoys_read
+
+    half_B /= len(training_set)
+    std_half_B /= len(training_set)
+    other_half_B /= len(training_set)
+
+    average_phi_decoy = sum_phi_decoy / total_decoys
+    A = average_phi_decoy - phi_native
+    B = half_B - other_half_B
+
+    return A, B, half_B, other_half_B, std_half_B, average_phi_decoy
+
+def get_streamed_decoy_phis_generator(phi_list, num_decoys, random_seed=None, batch_size=10000, complexes_directory="../for_bindingE/", debug_directory=None,
+                                      native_structure_name="native_Rmodified"):
+    # Streaming mode: the RNA decoys of each protein are drawn as in generate_decoy_seq_RNA.py, scored on the contact pairs
+    # cached by evaluate_phi.py in <complexes_directory>/<protein>/structure_artifacts/, and handed to the A/B accumulators
+    # block by block, so neither the .decoys file nor the decoy phi files are written, and the memory stays at one block;
+    # debug_directory, if given, keeps the streamed decoys and their phis as <protein>.decoys and a phi store;
+    alphabet = "agcu"
+
+    def streamed_decoy_phis(protein):
+        complex_directory = os.path.join(complexes_directory, protein)
+        randomization_directory = os.path.join(complex_directory, "sequences", "RNA_randomization")
+        with open(os.path.join(randomization_directory, "native.seq"), "r") as sequence_file:
+            native_sequence = sequence_file.read().replace('\n', '')
+        positions = read_randomize_positions(os.path.join(randomization_directory, "randomize_position_RNA.txt"))
+        gBinder_codes = get_excluded_sequence_codes(native_sequence, open(os.path.join(
+            randomization_directory, "gBinder_sequences.txt"), 'r').read().splitlines(), positions, alphabet)
+
+        pair_weight_matrices = []
+        for phi, parameters in phi_list:
+            # The artifact of the PDB and .tm files now in the complex folder, i.e. of the same structure as its native phis;
+            artifact = load_structure_artifact(find_structure_artifact(native_structure_name, phi, get_parameters_string(parameters),
+                                                                       complex_directory=complex_directory))
+            contact_residues, pair_weight_matrix = get_pair_weight_matrix(
+                artifact['res1_indices'], artifact['res2_indices'], artifact['weights'])
+            pair_weight_matrices.append((contact_residues, pair_weight_matrix, len(artifact['res_types'])))
+
+        if debug_directory is not None:
+            decoys_file = open(os.path.join(debug_directory, "%s.decoys" % protein), 'wb')
+            phi_store_file = None
+        random_generator = np.random.default_rng(random_seed)
+        for decoy_sequences in iterate_randomized_sequence_blocks(native_sequence, positions, alphabet, num_decoys, random_generator,
+                                                                  excluded_codes=gBinder_codes, block_size=batch_size):
+            phis = np.concatenate([get_phis_from_pair_weight_matrix(
+                get_sequence_array_res_types(decoy_sequences, num_residues)[:, contact_residues], pair_weight_matrix)
+                for contact_residues, pair_weight_matrix, num_residues in pair_weight_matrices], axis=1)
+            if debug_directory is not None:
+                write_sequence_array(decoys_file, decoy_sequences)
+                if phi_store_file is None:
+                    phi_store_file = open_phi_store(os.path.join(debug_directory, "%s_decoys" % protein), "streamed", "", phis.shape[1])
+                append_phi_store(phi_store_file, phis)
+            yield phis
+        if debug_directory is not None:
+            decoys_file.close()
+            if phi_store_file is not None:
+                close_phi_store(phi_store_file)
+
+    return streamed_decoy_phis
+
+
+def calculate_A_B_and_gamma_xl23(training_set_file, phi_list_file_name, decoy_method, num_decoys, noise_filtering=True, jackhmmer=False, chunk_size=None, gram=False, blas_num_threads=None, cutoff_mode=None, noise_iterations=10, decoy_phis_generator=None, random_seed=None):
     phi_list = read_phi_list(phi_list_file_name)
     training_set = read_column_from_file(training_set_file, 1)
 
@@ -146,18 +364,42 @@ def calculate_A_B_and_gamma_xl23(training_set_file, phi_list_file_name, decoy_me
     phi_summary_file_name = file_prefix + '_phi_native_summary.txt'
     np.savetxt(phi_summary_file_name, phi_native, fmt='%1.5f')
 
-    phi_i_protein_i_decoy = np.zeros(
-        (len(training_set), num_decoys, total_phis))
+    # The in-memory path needs num_decoys unweighted decoys for every protein, so weighted (unique) decoy sets
+    # are always accumulated with the Gram matrices;
+    if not gram and not chunk_size and any([read_decoy_phis_weights(protein, phi_list, num_decoys, decoy_method, jackhmmer=jackhmmer)
+                                            is not None for protein in training_set]):
+        gram = True
+    # Streamed decoy phis (see get_streamed_decoy_phis_generator) are only accumulated with the Gram matrices;
+    if decoy_phis_generator is not None:
+        gram = True
+
+    # Accumulate the Gram matrices of the decoy phis with BLAS, one chunk of decoys at a time;
+    if gram:
+        A, B, half_B, other_half_B, std_half_B, average_phi_decoy = calculate_A_and_B_gram(
+            phi_native, training_set, phi_list, total_phis, num_decoys, decoy_method, chunk_size=chunk_size or num_decoys,
+            num_threads=blas_num_threads, jackhmmer=jackhmmer, decoy_phis_generator=decoy_phis_generator)
+    # Stream the decoy phis from disk in chunks instead of holding every decoy (and their outer products) in memory;
+    elif chunk_size:
+        A, B, half_B, other_half_B, std_half_B, average_phi_decoy = calculate_A_and_B_streaming(
+            phi_native, training_set, phi_list, total_phis, num_decoys, decoy_method, chunk_size=chunk_size, jackhmmer=jackhmmer)
+    else:
+        phi_i_protein_i_decoy = np.zeros(
+            (len(training_set), num_decoys, total_phis))
 
-    for i_protein, protein in enumerate(training_set):
-        phi_i_protein_i_decoy[i_protein] = read_decoy_phis(
-            protein, phi_list, total_phis, num_phis, num_decoys, decoy_method, jackhmmer=jackhmmer)
+        for i_protein, protein in enumerate(training_set):
+            phi_i_protein_i_decoy[i_protein] = read_decoy_phis(
+                protein, phi_list, total_phis, num_phis, num_decoys, decoy_method, jackhmmer=jackhmmer)
 
-    # The phi_i decoy is constructed as the union of all decoys of all proteins in the training set;
-    phi_i_decoy = np.reshape(phi_i_protein_i_decoy,
-                             (len(training_set) * num_decoys, total_phis))
+        # The phi_i decoy is constructed as the union of all decoys of all proteins in the training set;
+        phi_i_decoy = np.reshape(phi_i_protein_i_decoy,
+                                 (len(training_set) * num_decoys, total_phis))
 
-    average_phi_decoy = np.average(phi_i_decoy, axis=0)
+        average_phi_decoy = np.average(phi_i_decoy, axis=0)
+
+        #A, B, half_B, other_half_B, std_half_B = calculate_A_and_B(
+        #    average_phi_decoy, phi_native, total_phis, num_decoys, phi_i_decoy)
+        A, B, half_B, other_half_B, std_half_B = calculate_A_and_B_wei(
+            average_phi_decoy, phi_native, phi_i_protein_i_decoy)
 
     # Output to a file;
     file_prefix = "%s%s_%s" % (phis_directory, training_set_file.split(
@@ -165,11 +407,6 @@ def calculate_A_B_and_gamma_xl23(training_set_file, phi_list_file_name, decoy_me
     phi_summary_file_name = file_prefix + '_phi_decoy_summary.txt'
     np.savetxt(phi_summary_file_name, average_phi_decoy, fmt='%1.5f')
 
-    #A, B, half_B, other_half_B, std_half_B = calculate_A_and_B(
-    #    average_phi_decoy, phi_native, total_phis, num_decoys, phi_i_decoy)
-    A, B, half_B, other_half_B, std_half_B = calculate_A_and_B_wei(
-        average_phi_decoy, phi_native, phi_i_protein_i_decoy)
-
     gamma = np.dot(np.linalg.pinv(B), A)
 
     # write gamma file
@@ -191,7 +428,8 @@ def calculate_A_B_and_gamma_xl23(training_set_file, phi_list_file_name, decoy_me
 
     if noise_filtering:
         filtered_gamma, filtered_B, filtered_lamb, P, lamb = get_filtered_gamma_B_lamb_P_and_lamb(
-            A, B, half_B, other_half_B, std_half_B, total_phis, num_decoys)
+            A, B, half_B, other_half_B, std_half_B, total_phis, num_decoys, noise_iterations=noise_iterations, cutoff_mode=cutoff_mode,
+            random_seed=random_seed)
         # gamma_file_name = "%sfiltered_%s_%s_gamma.dat" % (gammas_directory, training_set_file.split('/')[-1].split('.')[0], full_parameters_string)
         # gamma_file = open(gamma_file_name, 'w')
         filtered_gamma_file_name = file_prefix + '_gamma_filtered'
@@ -227,5 +465,14 @@ def calculate_A_B_and_gamma_xl23(training_set_file, phi_list_file_name, decoy_me
 
 gammas_directory = "./gammas/randomized_decoy/"
 
-calculate_A_B_and_gamma_xl23("native_trainSetFiles.txt", "phi1_list.txt", decoy_method='CPLEX_randomization', 
-                             num_decoys=10000, noise_filtering=True, jackhmmer=False)
+# Only train when run as a script, so that tests can import the functions above;
+if __name__ == "__main__":
+    calculate_A_B_and_gamma_xl23("native_trainSetFiles.txt", "phi1_list.txt", decoy_method='CPLEX_randomization', 
+                                 num_decoys=10000, noise_filtering=True, jackhmmer=False, chunk_size=10000, gram=True, blas_num_threads=None,
+                                 cutoff_mode=None, noise_iterations=100)
+
+    # Streaming mode: draw the decoys and score them on the fly instead of reading the decoy phi files;
+    #calculate_A_B_and_gamma_xl23("native_trainSetFiles.txt", "phi1_list.txt", decoy_method='CPLEX_randomization',
+    #                             num_decoys=1000000, noise_filtering=True, jackhmmer=False, chunk_size=10000, gram=True, blas_num_threads=None,
+    #                             cutoff_mode=None, noise_iterations=100,
+    #                             decoy_phis_generator=get_streamed_decoy_phis_generator(read_phi_list("phi1_list.txt"), 1000000, random_seed=0))
@@ -129,12 +129,12 @@ def read_all_gammas(phi_list_file_name, training_set_file, training_decoy_method
         confidence_upper = np.loadtxt(os.path.join(gammas_directory, "%s_%s_confidence_upper_%d_%d" % (training_set_file.split(
             '/')[-1].split('.')[0], full_parameters_string, bootstrapping_confidence, bootstrapping_iterations)))
 
-    # Need to filter out the complex number if in the "filtered" mode;
-    if noise_filtering:
-        gamma = np.loadtxt(gamma_file_name, dtype=complex, converters={
-                           0: lambda s: complex(s.decode().replace('+-', '-'))})
-    else:
+    # Gammas are real; only filtered gamma files from the old eig-based solver need the complex parsing;
+    try:
         gamma = np.loadtxt(gamma_file_name)
+    except ValueError:
+        gamma = np.real(np.loadtxt(gamma_file_name, dtype=complex, converters={
+                        0: lambda s: complex((s.decode() if isinstance(s, bytes) else s).replace('+-', '-'))}))
 
     individual_gammas = []
     individual_confidence_lower = []
@@ -0,0 +1,46 @@
+import os
+import shutil
+
+import numpy as np
+
+from test_phi_cache import complex_directory, load_module, make_complex_folder, repo_directory
+
+
+def test_mutational_scan_skips_nonstandard_residue(tmp_path, monkeypatch):
+    evaluate_phi = load_module("template_evaluate_phi", os.path.join(
+        repo_directory, "IRIS_model/training/optimization/for_bindingE/template/template_evaluate_phi.py"), monkeypatch)
+    mutational_scan = load_module("mutational_scan", os.path.join(repo_directory, "IRIS_model/testing/mutational_scan.py"), monkeypatch)
+    monkeypatch.setattr(evaluate_phi, "phi_cache_directory", "")
+
+    tables = {}
+    for folder in ["native", "nonstandard"]:
+        make_complex_folder(str(tmp_path / folder))
+        shutil.copy(os.path.join(complex_directory, "sequences/RNA_randomization/randomize_position_RNA.txt"), str(tmp_path / folder / "sequences"))
+        monkeypatch.chdir(tmp_path / folder)
+        if folder == "nonstandard":
+            # Rename a protein residue outside every contacting pair to a residue name without a residue type;
+            artifact = evaluate_phi.load_structure_artifact(evaluate_phi.find_structure_artifact(
+                "native_Rmodified", "phi_pairwise_contact_well", "-9.5_9.5_0.7_10", complex_directory=str(tmp_path / "native")))
+            contacts = set(np.concatenate((artifact['res1_indices'], artifact['res2_indices'])))
+            pdb_file_name = "native_structures_pdbs_with_virtual_cbs/native_Rmodified.pdb"
+            pdb_arrays = evaluate_phi.read_pdb_arrays(pdb_file_name)
+            index = [i for i in range(len(pdb_arrays['resnames'])) if i not in contacts and pdb_arrays['resnames'][i] == "ALA"][0]
+            residue = (pdb_arrays['chain_ids'][index], int(pdb_arrays['res_ids'][index]))
+            lines = open(pdb_file_name).readlines()
+            open(pdb_file_name, 'w').writelines([line[:17] + "MSE" + line[20:] if line.startswith("ATOM") and
+                                                 (line[21], int(line[22:26])) == residue else line for line in lines])
+        evaluate_phi.evaluate_phis_for_complex("2c4q", partner_chains=["A"])
+
+        if folder == "native":
+            np.savetxt("gamma.txt", np.random.default_rng(0).normal(size=evaluate_phi.pair_phi_index_map.max() + 1))
+        else:
+            shutil.copy(str(tmp_path / "native" / "gamma.txt"), "gamma.txt")
+        mutational_scan.mutational_scan("gamma.txt", "mutational_scan.txt", top_k=20, doubles=True,
+                                        RNA_positions_file_name="sequences/randomize_position_RNA.txt")
+        tables[folder] = open("mutational_scan.txt").read()
+
+    # The nonstandard residue is in no contact, so the ranked mutants and their energies do not change;
+    assert evaluate_phi.load_structure_artifact(evaluate_phi.find_structure_artifact(
+        "native_Rmodified", "phi_pairwise_contact_well", "-9.5_9.5_0.7_10"))['res_types'][index] == -1
+    assert tables["nonstandard"] == tables["native"]
+    assert len(tables["native"].splitlines()) == 21
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+from test_phi_cache import load_module, repo_directory
+
+phi_list = [['phi_pairwise_contact_well', ['-9.5', '9.5', '0.7', '10']]]
+total_phis = 12
+
+
+@pytest.fixture
+def optimize_gamma(monkeypatch):
+    return load_module("optimize_gamma", os.path.join(repo_directory, "IRIS_model/training/optimization/for_training_gamma/optimize_gamma.py"),
+                       monkeypatch)
+
+
+@pytest.fixture
+def decoy_phis(optimize_gamma, tmp_path, monkeypatch):
+    # Decoy phi files of two proteins in a phis folder, one of them with multiplicity weights; returns the native phi and
+    # the decoys of each protein expanded by their weights, which calculate_A_and_B_wei scores as its reference;
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("phis")
+    random_generator = np.random.default_rng(0)
+    phi_native = random_generator.integers(0, 4, size=total_phis).astype(float)
+    weights = {"first": random_generator.integers(1, 4, size=20)}
+    phis = {"first": random_generator.integers(0, 4, size=(20, total_phis)) * 0.5,
+            "second": random_generator.integers(0, 4, size=(int(np.sum(weights["first"])), total_phis)) * 0.5}
+    for protein in phis:
+        phi_file_name = optimize_gamma.get_decoy_phi_file_name(phi_list[0][0], protein, optimize_gamma.get_parameters_string(phi_list[0][1]),
+                                                               "CPLEX_randomization")
+        np.savetxt(phi_file_name, phis[protein])
+        if protein in weights:
+            optimize_gamma.write_decoy_weights(phi_file_name + optimize_gamma.decoy_weights_extension, weights[protein])
+    expanded_phis = np.array([np.repeat(phis["first"], weights["first"], axis=0), phis["second"]])
+    return phi_native, expanded_phis
+
+
+def assert_same_A_and_B(reference, result):
+    # A, B, half_B, other_half_B and std_half_B;
+    for reference_value, value in zip(reference[:5], result[:5]):
+        assert value == pytest.approx(reference_value, rel=1e-9, abs=1e-12)
+
+
+def test_streaming_matches_wei_with_weighted_decoys(optimize_gamma, decoy_phis):
+    phi_native, expanded_phis = decoy_phis
+    reference = optimize_gamma.calculate_A_and_B_wei(expanded_phis.reshape(-1, total_phis).mean(axis=0), phi_native, expanded_phis)
+    result = optimize_gamma.calculate_A_and_B_streaming(phi_native, ["first", "second"], phi_list, total_phis, 1000, "CPLEX_randomization",
+                                                        chunk_size=7)
+    assert_same_A_and_B(reference, result)
+
+
+def test_gram_matches_wei_with_weighted_decoys(optimize_gamma, decoy_phis):
+    phi_native, expanded_phis = decoy_phis
+    reference = optimize_gamma.calculate_A_and_B_wei(expanded_phis.reshape(-1, total_phis).mean(axis=0), phi_native, expanded_phis)
+    result = optimize_gamma.calculate_A_and_B_gram(phi_native, ["first", "second"], phi_list, total_phis, 1000, "CPLEX_randomization",
+                                                   chunk_size=7)
+    assert_same_A_and_B(reference, result)
+
+
+def test_gram_raises_without_threadpoolctl(optimize_gamma, decoy_phis, monkeypatch):
+    phi_native, expanded_phis = decoy_phis
+    monkeypatch.setattr(optimize_gamma, "threadpool_limits", None)
+    with pytest.raises(ImportError):
+        optimize_gamma.calculate_A_and_B_gram(phi_native, ["first", "second"], phi_list, total_phis, 1000, "CPLEX_randomization",
+                                              num_threads=1)
+
+
+def test_filtered_gamma_matches_eig_and_inverse(optimize_gamma, decoy_phis):
+    phi_native, expanded_phis = decoy_phis
+    A, B, half_B, other_half_B, std_half_B = optimize_gamma.calculate_A_and_B_wei(
+        expanded_phis.reshape(-1, total_phis).mean(axis=0), phi_native, expanded_phis)
+    cutoff_mode = 8
+    filtered_gamma, filtered_B, filtered_lamb, P, lamb = optimize_gamma.get_filtered_gamma_B_lamb_P_and_lamb(
+        A, B, half_B, other_half_B, std_half_B, total_phis, expanded_phis.shape[1], cutoff_mode=cutoff_mode)
+
+    # The original solver: eig of B, and the filtered B inverted explicitly;
+    reference_lamb, reference_P = optimize_gamma.sort_eigenvalues_and_eigenvectors(*np.linalg.eig(B))
+    reference_filtered_lamb = np.real(reference_lamb).copy()
+    reference_filtered_lamb[cutoff_mode:] = reference_filtered_lamb[cutoff_mode - 1]
+    reference_filtered_B_inv = np.dot(reference_P, np.dot(np.diag(1 / reference_filtered_lamb), np.linalg.inv(reference_P)))
+    assert lamb == pytest.approx(np.real(reference_lamb), rel=1e-9)
+    assert filtered_gamma == pytest.approx(np.real(np.dot(reference_filtered_B_inv, A)), rel=1e-8, abs=1e-10)
+    assert filtered_B == pytest.approx(np.real(np.linalg.inv(reference_filtered_B_inv)), rel=1e-8, abs=1e-10)
@@ -0,0 +1,51 @@
+import importlib.util
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+repo_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+common_functions_directory = os.path.join(repo_directory, "IRIS_model/training/common_functions")
+complex_directory = os.path.join(repo_directory, "IRIS_model/training/optimization/for_bindingE/2c4q")
+
+
+def load_module(name, file_name, monkeypatch):
+    monkeypatch.syspath_prepend(common_functions_directory)
+    module_spec = importlib.util.spec_from_file_location(name, file_name)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return module
+
+
+def make_complex_folder(folder, num_decoys=50):
+    os.makedirs(os.path.join(folder, "phis"))
+    os.makedirs(os.path.join(folder, "sequences/CPLEX_randomization"))
+    for name in ["native_structures_pdbs_with_virtual_cbs", "tms"]:
+        shutil.copytree(os.path.join(complex_directory, name), os.path.join(folder, name))
+    for name in ["phi1_list.txt", "proteins_list_forphi.txt"]:
+        shutil.copy(os.path.join(complex_directory, name), folder)
+    decoys = open(os.path.join(complex_directory, "sequences/CPLEX_randomization/native_Rmodified.decoys")).readlines()[:num_decoys]
+    open(os.path.join(folder, "sequences/CPLEX_randomization/native_Rmodified.decoys"), 'w').writelines(decoys)
+
+
+def test_phi_cache_hit_writes_structure_artifact(tmp_path, monkeypatch):
+    evaluate_phi = load_module("template_evaluate_phi", os.path.join(
+        repo_directory, "IRIS_model/training/optimization/for_bindingE/template/template_evaluate_phi.py"), monkeypatch)
+    score_sequences = load_module("score_sequences", os.path.join(repo_directory, "IRIS_model/testing/score_sequences.py"), monkeypatch)
+    monkeypatch.setattr(evaluate_phi, "phi_cache_directory", str(tmp_path / "cache"))
+
+    # Evaluate the same complex in two folders against one cache; the second one reuses the cached phis;
+    for folder in ["first", "second"]:
+        make_complex_folder(str(tmp_path / folder))
+        monkeypatch.chdir(tmp_path / folder)
+        evaluate_phi.evaluate_phis_for_complex("2c4q", partner_chains=["A"])
+    assert len(os.listdir(str(tmp_path / "cache"))) == 1
+    assert len(os.listdir("structure_artifacts")) > 0
+
+    # Scoring from the second folder gives gamma . phi of its (cached) decoy phis;
+    phis = evaluate_phi.read_phi_file("phis/phi_pairwise_contact_well_native_Rmodified_decoys_CPLEX_randomization_-9.5_9.5_0.7_10")
+    gamma = np.random.default_rng(0).normal(size=phis.shape[1])
+    np.savetxt("gamma.txt", gamma)
+    score_sequences.score_sequences("gamma.txt", "sequences/CPLEX_randomization/native_Rmodified.decoys", "energies.txt")
+    assert np.loadtxt("energies.txt") == pytest.approx(np.dot(phis, gamma), abs=1e-5)
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from test_phi_cache import load_module, make_complex_folder, repo_directory
+
+parameter_list = ['-9.5', '9.5', '0.7', '10']
+
+
+def reference_phi_pairwise_contact_well(common, res_list_tmonly, res_list_entire, neighbor_list, parameter_list, partner_chains):
+    # The per-residue loop of the original CPLEX phi_pairwise_contact_well, against which the vectorized phis are checked;
+    r_min, r_max, kappa, min_seq_sep = [float(parameter) for parameter in parameter_list]
+    phi_pairwise_contact_well = np.zeros((24, 24))
+    for res1 in res_list_entire:
+        if res1 not in res_list_tmonly:
+            continue
+        for res2 in common.get_neighbors_within_radius(neighbor_list, res1, r_max + 2.0):
+            if common.get_chain(res2) not in partner_chains:
+                continue
+            res1type = common.get_res_type(res_list_entire, res1)
+            res2type = common.get_res_type(res_list_entire, res2)
+            rij = common.get_interaction_distance(res1, res2)
+            phi_pairwise_contact_well[res1type][res2type] += common.interaction_well(rij, r_min, r_max, kappa)
+            if not res1type == res2type:
+                phi_pairwise_contact_well[res2type][res1type] += common.interaction_well(rij, r_min, r_max, kappa)
+    return phi_pairwise_contact_well[np.triu_indices(24)]
+
+
+@pytest.fixture
+def complex_structure(tmp_path, monkeypatch):
+    # The parsed 2c4q complex, its contacting pairs and the reference phis of its native and first decoy sequences;
+    evaluate_phi = load_module("template_evaluate_phi", os.path.join(
+        repo_directory, "IRIS_model/training/optimization/for_bindingE/template/template_evaluate_phi.py"), monkeypatch)
+    make_complex_folder(str(tmp_path), num_decoys=6)
+    monkeypatch.chdir(tmp_path)
+    structure = evaluate_phi.parse_pdb("native_structures_pdbs_with_virtual_cbs/native_Rmodified")
+    res_list_tmonly = evaluate_phi.get_res_list(structure, tm_only=True)
+    res_list_entire = evaluate_phi.get_res_list(structure)
+    neighbor_list = evaluate_phi.get_neighbor_list(structure)
+    pairs = evaluate_phi.phi_pairwise_contact_well_pairs(res_list_tmonly, res_list_entire, neighbor_list, parameter_list,
+                                                         CPLEXmodeling=True, CPLEX_name="2c4q", partner_chains=["A"])
+
+    sequences = evaluate_phi.read_decoy_sequences("sequences/CPLEX_randomization/native_Rmodified.decoys")
+    reference_phis = []
+    for sequence in sequences:
+        evaluate_phi.mutate_whole_sequence(res_list_entire, sequence)
+        reference_phis.append(reference_phi_pairwise_contact_well(evaluate_phi, res_list_tmonly, res_list_entire, neighbor_list,
+                                                                  parameter_list, ["A"]))
+    return evaluate_phi, pairs, sequences, len(res_list_entire), np.array(reference_phis)
+
+
+def test_contact_pairs_phis_match_scalar_loop(complex_structure):
+    evaluate_phi, (res1_indices, res2_indices, weights), sequences, num_residues, reference_phis = complex_structure
+    assert len(weights) > 0 and reference_phis.any()
+    for sequence, reference_phi in zip(sequences, reference_phis):
+        res_types = evaluate_phi.get_sequence_res_types(sequence, num_residues)
+        phis = evaluate_phi.get_phis_from_contact_pairs(res_types, res1_indices, res2_indices, weights)
+        assert phis == pytest.approx(reference_phi, abs=1e-10)
+
+
+def test_pair_weight_matrix_phis_match_scalar_loop(complex_structure):
+    evaluate_phi, (res1_indices, res2_indices, weights), sequences, num_residues, reference_phis = complex_structure
+    contact_residues, pair_weight_matrix = evaluate_phi.get_pair_weight_matrix(res1_indices, res2_indices, weights)
+    res_types_block = evaluate_phi.get_sequences_res_types(sequences, num_residues)
+    phis = evaluate_phi.get_phis_from_pair_weight_matrix(res_types_block[:, contact_residues], pair_weight_matrix)
+    assert phis == pytest.approx(reference_phis, abs=1e-10)